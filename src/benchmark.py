@@ -0,0 +1,155 @@
+"""Benchmarks of the inference, generation, I/O and rendering hot paths.
+
+Run from src/:
+
+    python benchmark.py --output ../out/benchmark.json --baseline ../out/benchmark_baseline.json
+
+Every case is timed over a matrix of map sizes and step counts and written as JSON. With a baseline (the output of an
+earlier run) each case is compared against it and the run fails if a case is slower than the baseline by more than
+the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy
+
+from grid import BeliefCache, Grid
+
+SIZES = ((3, 4), (100, 50), (1000, 1000))
+STEPS = (10, 100)
+
+
+def measure(function, repeat=5, min_time=0.2):
+    """Seconds per call of function: the calls are batched so each timing lasts at least min_time, then repeated."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    return {'median': statistics.median(timings), 'best': min(timings), 'number': number, 'repeat': repeat}
+
+
+def cases(sizes, steps, directory):
+    """(name, parameters, function) for every benchmarked call; the inputs of each size are built up front so only
+    the call itself is timed."""
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    from render import GridRenderer
+    pygame.init()
+
+    for rows, columns in sizes:
+        size = f'{rows}x{columns}'
+        grid = Grid.generate_grid(rows, columns, seed=0)
+        experiments = Grid.generate_experiments(grid, 1, max(steps), seed=0)
+        ground_truth_states, actions, sensor_readings = Grid.decode_experiment(experiments, 0)
+
+        yield 'generate_grid', {'size': size}, lambda: Grid.generate_grid(rows, columns)
+        yield 'generate_experiment', {'size': size, 'steps': 100}, lambda: Grid.generate_experiment(grid)
+
+        grid_filepath = os.path.join(directory, f'grid_{size}.txt')
+        Grid.save_grid(grid, grid_filepath)
+        yield 'save_grid', {'size': size}, lambda: Grid.save_grid(grid, grid_filepath)
+        yield 'import_grid', {'size': size}, lambda: Grid.import_grid(grid_filepath)
+
+        experiment_filepath = os.path.join(directory, f'grid_{size}_experiment.txt')
+        Grid.save_experiment(ground_truth_states, actions, sensor_readings, experiment_filepath)
+        for num_steps in steps:
+            yield 'import_experiment', {'size': size, 'steps': num_steps}, \
+                lambda: Grid.import_experiment(experiment_filepath, num_steps)
+            yield 'calculate_next_probabilities', {'size': size, 'steps': num_steps}, \
+                lambda: Grid.calculate_next_probabilities(grid, actions, sensor_readings, 0, num_steps)
+
+        # one redraw of the draw_grid window at the last step
+        renderer = GridRenderer(grid)
+        window = pygame.Surface((1000, 1000))
+        probabilities = BeliefCache().get(grid, actions, sensor_readings, len(actions))
+
+        def redraw():
+            window.fill(Grid.WHITE)
+            renderer.render(window, probabilities, len(actions), 1)
+
+        yield 'draw_grid', {'size': size}, redraw
+
+
+def case_key(name, parameters):
+    return name + '[' + ','.join(f'{key}={value}' for key, value in parameters.items()) + ']'
+
+
+def run(sizes=SIZES, steps=STEPS, repeat=5, min_time=0.2):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, parameters, function in cases(sizes, steps, directory):
+            key = case_key(name, parameters)
+            results[key] = dict(name=name, **parameters, **measure(function, repeat, min_time))
+            print(f'[INFO] {key}: {results[key]["median"] * 1000:.3f} ms')
+    return {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def compare(report, baseline, tolerance=0.25):
+    """Ratio of every case's median to the baseline's, and the keys of the cases slower than 1 + tolerance times
+    the baseline."""
+    ratios, regressions = {}, []
+    for key, result in report['results'].items():
+        if key not in baseline['results']:
+            continue
+        ratios[key] = result['median'] / baseline['results'][key]['median']
+        if ratios[key] > 1 + tolerance:
+            regressions.append(key)
+    return ratios, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', default='../out/benchmark.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--sizes', nargs='+', default=[f'{r}x{c}' for r, c in SIZES])
+    parser.add_argument('--steps', nargs='+', type=int, default=list(STEPS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    sizes = [tuple(int(x) for x in size.split('x')) for size in args.sizes]
+    report = run(sizes, args.steps, args.repeat, args.min_time)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        ratios, regressions = compare(report, baseline, args.tolerance)
+        for key, ratio in ratios.items():
+            report['results'][key]['baseline_ratio'] = ratio
+            print(f'[{"FAILED" if key in regressions else "PASSED"}] {key}: {ratio:.2f}x baseline')
+
+    if os.path.dirname(args.output) and not os.path.exists(os.path.dirname(args.output)):
+        os.makedirs(os.path.dirname(args.output))
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f'[INFO] Saved {args.output}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
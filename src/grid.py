@@ -1,12 +1,14 @@
+import bisect
+import collections
+import functools
+import json
 import math
+import multiprocessing
 
 import numpy
-import pygame
-import random
-import sys
 import os
+import time
 from datetime import datetime
-from pygame.locals import *
 
 
 class Grid:
@@ -19,217 +21,51 @@ class Grid:
 
     NORMAL, HIGHWAY, HARD_TO_TRAVERSE, BLOCKED = 'N', 'H', 'T', 'B'
     UP, DOWN, LEFT, RIGHT = 'U', 'D', 'L', 'R'
+    MOVES = {UP: (-1, 0), DOWN: (1, 0), LEFT: (0, -1), RIGHT: (0, 1)}
 
     @classmethod
     def import_grid(cls, filepath):
-        grid = None
+        # binary grids are memory-mapped instead of being read into memory
+        if os.path.splitext(filepath)[1] == '.npy':
+            return TerrainGrid(numpy.load(filepath, mmap_mode='r'))
+
         with open(filepath, "r") as file:
-            rows, columns = map(int, file.readline().split(' '))
-            grid = [['' for c in range(columns)] for r in range(rows)]
-            for line in file:
-                r, c, t = line.split()
-                row, column, terrain = int(r), int(c), t
-                grid[row - 1][column - 1] = terrain
-        return grid
+            tokens = file.read().split()
+        rows, columns = int(tokens[0]), int(tokens[1])
+        row_indices = numpy.fromiter(map(int, tokens[2::3]), dtype=numpy.intp)
+        column_indices = numpy.fromiter(map(int, tokens[3::3]), dtype=numpy.intp)
+        codes = numpy.full((rows, columns), TerrainGrid.CODES[Grid.BLOCKED], dtype=numpy.uint8)
+        codes[row_indices - 1, column_indices - 1] = TerrainGrid.encode(''.join(tokens[4::3]))
+        return TerrainGrid(codes)
 
     @classmethod
     def save_grid(cls, grid, filepath):
-        rows, columns = len(grid), len(grid[0])
+        grid = TerrainGrid.from_rows(grid)
+        if os.path.splitext(filepath)[1] == '.npy':
+            numpy.save(filepath, grid.codes)
+            return filepath
+
         with open(filepath, "w") as file:
-            file.write(f'{rows} {columns}\n')
-            for row in range(rows):
-                for column in range(columns):
-                    file.write(f'{row + 1} {column + 1} {grid[row][column]}\n')
+            file.write(f'{grid.rows} {grid.columns}\n')
+            file.writelines(f'{row + 1} {column + 1} {terrain}\n'
+                            for row, line in enumerate(grid) for column, terrain in enumerate(line))
         return filepath
 
     @classmethod
-    def generate_grid(cls, rows, columns):
-        grid = [['' for c in range(columns)] for r in range(rows)]
-        for row in range(rows):
-            for column in range(columns):
-                num = random.uniform(0, 1)
-                if 0 <= num <= 0.5:
-                    grid[row][column] = Grid.NORMAL
-                elif 0.5 < num <= 0.7:
-                    grid[row][column] = Grid.HIGHWAY
-                elif 0.7 < num <= 0.9:
-                    grid[row][column] = Grid.HARD_TO_TRAVERSE
-                else:
-                    grid[row][column] = Grid.BLOCKED
-                pass
-        return grid
-
-    @classmethod
-    def draw_grid(cls, grid, actions, sensor_readings, experiment_filepath=None):
-        base_cell_size = 150
-        base_border_size = 2
-        base_font_size = 15
-        base_line_width = 5
-        base_circle_radius = 10
-        width, height = 1000, 1000
-        rows, columns = len(grid), len(grid[0])
-
-        pygame.init()
-
-        canvas = pygame.Surface((base_cell_size * (columns + 1), base_cell_size * (rows + 1)))
-        canvas.fill(Grid.WHITE)
-        canvas_rect = canvas.get_rect()
-
-        def draw():
-            nonlocal canvas
-            nonlocal canvas_rect
-            nonlocal probabilities
-            nonlocal step
-            nonlocal zoom
-
-            border_size = max(1, round(base_border_size * zoom))
-            offset = border_size // 2
-            cell_size = max(1, round(base_cell_size * zoom))
-            font_size = max(1, round(base_font_size * zoom))
-            line_width = max(1, round(base_line_width * zoom))
-            circle_radius = max(1, round(base_circle_radius * zoom))
-
-            canvas = pygame.Surface((cell_size * (columns + 1), cell_size * (rows + 1)))
-            canvas.fill(Grid.WHITE)
-            canvas_rect = canvas.get_rect()
-
-            # Create border with the same size as the grid, centered in image.
-            border_rect = pygame.Rect(0, 0, columns * cell_size - (border_size * (columns - 1)),
-                                      rows * cell_size - (border_size * (rows - 1)))
-            border_rect.center = (canvas.get_width() // 2, canvas.get_height() // 2)
-
-            # Create cells
-            for row in range(rows):
-                for column in range(columns):
-                    # get position of cell
-                    left = border_rect.left + column * (cell_size - border_size)
-                    right = left + cell_size - border_size
-                    top = border_rect.top + row * (cell_size - border_size)
-                    bottom = top + cell_size - border_size
-
-                    # get color of cell
-                    color = None
-                    match grid[row][column]:
-                        case Grid.HIGHWAY:
-                            color = Grid.GOLD
-                        case Grid.HARD_TO_TRAVERSE:
-                            color = Grid.GREEN
-                        case Grid.BLOCKED:
-                            color = Grid.GRAY
-                        case Grid.NORMAL:
-                            color = Grid.WHITE
-
-                    # draw cell color
-                    pygame.draw.rect(canvas, color, (left, top, cell_size, cell_size))
-
-                    # draw cell borders
-                    pygame.draw.rect(canvas, Grid.BLACK, pygame.Rect(left, top, cell_size, cell_size), border_size)
-
-                    # draw cell probabilities
-                    probability_label = pygame.font.SysFont('calibri', font_size).render(
-                        "{:.7f}".format(probabilities[row][column] * 100) + "%", True, Grid.BLACK)
-                    probability_label_rect = probability_label.get_rect(
-                        center=(left + cell_size // 2, top + cell_size // 2))
-                    canvas.blit(probability_label, probability_label_rect)
-
-            # draw grid labels
-            for column in range(1, columns + 2):
-                x_label = pygame.font.SysFont('calibri', font_size).render(str(column), True, Grid.BLACK)
-                x_label_rect = x_label.get_rect(center=(border_rect.left - column + (column - 1) * (cell_size - offset),
-                                                        border_rect.top - 4 * circle_radius))
-                canvas.blit(x_label, x_label_rect)
-            for row in range(1, rows + 2):
-                y_label = pygame.font.SysFont('calibri', font_size).render(str(row), True, Grid.BLACK)
-                y_label_rect = y_label.get_rect(center=(border_rect.left - 4 * circle_radius,
-                                                        border_rect.top - row + (row - 1) * (cell_size - offset)))
-                canvas.blit(y_label, y_label_rect)
-
-            # draw step label
-            step_label = pygame.font.SysFont('calibri', font_size).render(f'Step: {step}', True, Grid.BLACK)
-            step_label_rect = step_label.get_rect(left=font_size / 2, top=font_size / 2)
-            canvas.blit(step_label, step_label_rect)
-
-        zoom = 1
-        step = 0
-        probabilities = Grid.calculate_next_probabilities(grid, actions, sensor_readings, step, step)
-        position = [width // 2, height // 2]
-        draw()
-        moving = False
-
-        if experiment_filepath:
-            base = os.path.splitext(experiment_filepath)[0]
-
-            step = 10
-            probabilities = Grid.calculate_next_probabilities(grid, actions, sensor_readings, 0, step, probabilities)
-            draw()
-            pygame.image.save(canvas, base + f'_heatmap_step_{step}.png')
-
-            step = 50
-            probabilities = Grid.calculate_next_probabilities(grid, actions, sensor_readings, 10, step, probabilities)
-            draw()
-            pygame.image.save(canvas, base + f'_heatmap_step_{step}.png')
-
-            step = 100
-            probabilities = Grid.calculate_next_probabilities(grid, actions, sensor_readings, 50, step, probabilities)
-            draw()
-            pygame.image.save(canvas, base + f'_heatmap_step_{step}.png')
-
-            pygame.quit()
-            return
-
-        window = pygame.display.set_mode((width, height), pygame.RESIZABLE)
-        while True:
-            dirty = False
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-
-                # Set moving true while mouse button is held
-                elif event.type == MOUSEBUTTONDOWN:
-                    if canvas_rect.collidepoint(event.pos):
-                        moving = True
-
-                # Set moving false when mouse button is released
-                elif event.type == MOUSEBUTTONUP:
-                    moving = False
-
-                # Click and drag image
-                elif event.type == MOUSEMOTION and moving:
-                    pos = list(event.rel)
-                    canvas_rect.move_ip(pos)
+    def generate_grid(cls, rows, columns, seed=None):
+        """Random grid: 50% normal, 20% highway, 20% hard to traverse and 10% blocked cells.
 
-                # Zoom
-                elif event.type == MOUSEWHEEL:
-                    if event.y > 0.1:
-                        zoom += 0.1
-                    elif zoom > 0.2:
-                        zoom -= 0.1
+        seed is anything numpy.random.default_rng accepts, including a numpy.random.Generator.
+        """
+        num = numpy.random.default_rng(seed).uniform(0, 1, (rows, columns))
+        codes = numpy.searchsorted(numpy.array([0.5, 0.7, 0.9]), num, side='left').astype(numpy.uint8)
+        return TerrainGrid(codes)
 
-                    position[0] = round(canvas_rect.left * zoom)
-                    position[1] = round(canvas_rect.right * zoom)
-                    dirty = True
-
-                # Change Step
-                elif event.type == KEYDOWN and event.key == pygame.K_RIGHT and step < len(actions):
-                    probabilities = Grid.calculate_next_probabilities(grid, actions, sensor_readings, step, step + 1, probabilities)
-                    step += 1
-                    dirty = True
-
-            if dirty:
-                draw()
-
-            window.fill(Grid.WHITE)
-
-            # Set canvas and image
-            window.blit(canvas, canvas_rect)
-
-            # Construct image border
-            pygame.draw.rect(window, Grid.WHITE, canvas_rect, 2)
-
-            # Update screen
-            pygame.display.update()
+    @classmethod
+    def draw_grid(cls, grid, actions, sensor_readings, experiment_filepath=None, cache=None, metrics=None):
+        # pygame is only imported once a grid is drawn, see render.py
+        import render
+        return render.draw_grid(grid, actions, sensor_readings, experiment_filepath, cache, metrics)
 
     @classmethod
     def import_experiment(cls, filepath, num_actions):
@@ -264,143 +100,1476 @@ class Grid:
         return filepath
 
     @classmethod
-    def generate_experiment(cls, grid):
-        row, column = -1, -1
-        starting_row, starting_column = -1, -1
-        rows, columns = len(grid), len(grid[0])
-        coordinates = [(r, c) for r in range(rows) for c in range(columns)]
+    def encode_experiments(cls, experiments):
+        """Arrays in the generate_experiments layout from (ground_truth_states, actions, sensor_readings) tuples as
+        returned by import_experiment; all experiments must have the same number of steps."""
+        return {
+            'ground_truth': numpy.array([Grid.parse_ground_truth_locations(e[0]) for e in experiments],
+                                        dtype=numpy.intp).reshape(len(experiments), -1, 2),
+            'actions': Grid.encode_actions([e[1] for e in experiments]).astype(numpy.uint8),
+            'sensor_readings': numpy.array([TerrainGrid.encode(''.join(e[2])) for e in experiments],
+                                           dtype=numpy.uint8),
+        }
+
+    @classmethod
+    def save_experiments(cls, experiments, filepath):
+        """Save every experiment of a grid as one structured array with a record per experiment.
+
+        experiments is a generate_experiments or encode_experiments result, or an array from import_experiments.
+        """
+        num_experiments, num_steps = experiments['actions'].shape
+        if numpy.min(experiments['ground_truth']) < 0:
+            raise Exception("Ground truth locations must not be negative")
+        ground_truth_type = numpy.uint16 if numpy.max(experiments['ground_truth']) < 2 ** 16 else numpy.int32
+        records = numpy.empty(num_experiments, dtype=[('ground_truth', ground_truth_type, (num_steps + 1, 2)),
+                                                      ('actions', numpy.uint8, (num_steps,)),
+                                                      ('sensor_readings', numpy.uint8, (num_steps,))])
+        for field in ['ground_truth', 'actions', 'sensor_readings']:
+            records[field] = experiments[field]
+        numpy.save(filepath, records)
+        return filepath
+
+    @classmethod
+    def import_experiments(cls, filepath):
+        """Memory-map a save_experiments file; experiments['actions'][index] and decode_experiment(experiments, index)
+        only read the records they need."""
+        return numpy.load(filepath, mmap_mode='r')
 
-        # check if unblocked cells exist
-        if not any(terrain in row for terrain in [Grid.NORMAL, Grid.HIGHWAY, Grid.HARD_TO_TRAVERSE] for row in grid):
+    @classmethod
+    def sample_unblocked_cells(cls, grid, count, seed=None):
+        """Zero-based rows and columns of count cells drawn uniformly from the unblocked cells.
+
+        Cells are drawn from the whole grid and blocked ones are rejected, so the unblocked cells are never listed.
+        """
+        grid = TerrainGrid.from_rows(grid)
+        if numpy.all(grid.blocked):
             raise Exception("No unblocked cells exist")
+        random_generator = numpy.random.default_rng(seed)
 
-        # get random unblocked cell
-        while row == -1:
-            r, c = random.choice(coordinates)
-            if grid[r][c] != Grid.BLOCKED:
-                row = r
-                column = c
+        rows, columns = numpy.empty(0, dtype=numpy.intp), numpy.empty(0, dtype=numpy.intp)
+        while len(rows) < count:
+            r = random_generator.integers(0, grid.rows, count)
+            c = random_generator.integers(0, grid.columns, count)
+            unblocked = ~grid.blocked[r, c]
+            rows = numpy.concatenate([rows, r[unblocked]])[:count]
+            columns = numpy.concatenate([columns, c[unblocked]])[:count]
+        return rows, columns
 
-        # generate actions, ground truth states, and sensor readings
-        actions = []
-        ground_truth_states = [f'{row} {column}']  # append starting row and column
+    @classmethod
+    def generate_experiments(cls, grid, num_experiments, num_steps=100, seed=None, robot_model=None):
+        """Simulate num_experiments trajectories of num_steps random actions on the grid at once.
+
+        Returns a dict with zero-based 'ground_truth' cells (num_experiments x (num_steps + 1) x 2, starting with the
+        initial cell), 'actions' codes (indices into robot_model.actions) and 'sensor_readings' codes
+        (TerrainGrid.CODES), both num_experiments x num_steps uint8 arrays.
+        """
+        grid = TerrainGrid.from_rows(grid)
+        robot_model = robot_model or RobotModel.DEFAULT
+        random_generator = numpy.random.default_rng(seed)
+
+        ground_truth = numpy.empty((num_experiments, num_steps + 1, 2), dtype=numpy.intp)
+        rows, columns = Grid.sample_unblocked_cells(grid, num_experiments, random_generator)
+        ground_truth[:, 0, 0], ground_truth[:, 0, 1] = rows, columns
+
+        actions = random_generator.integers(0, len(robot_model.actions), (num_experiments, num_steps),
+                                            dtype=numpy.uint8)
+        moves = numpy.array([robot_model.moves[action] for action in robot_model.actions]).reshape(-1, 2)
+        reading_distributions = numpy.cumsum(robot_model.sensor_matrix, axis=1)
+        sensor_readings = numpy.empty((num_experiments, num_steps), dtype=numpy.uint8)
+        for step in range(num_steps):
+            # ground truth states: move with the model's probability unless the next cell is blocked or off the grid
+            next_rows = rows + moves[actions[:, step], 0]
+            next_columns = columns + moves[actions[:, step], 1]
+            move = (random_generator.uniform(0, 1, num_experiments) < robot_model.move_probability) \
+                & (next_rows >= 0) & (next_rows < grid.rows) & (next_columns >= 0) & (next_columns < grid.columns)
+            move[move] = ~grid.blocked[next_rows[move], next_columns[move]]
+            rows = numpy.where(move, next_rows, rows)
+            columns = numpy.where(move, next_columns, columns)
+            ground_truth[:, step + 1, 0], ground_truth[:, step + 1, 1] = rows, columns
+
+            # sensor readings: drawn from the row of the sensor matrix for the terrain of the cell
+            distributions = reading_distributions[grid.codes[rows, columns]]
+            readings = (random_generator.uniform(0, 1, (num_experiments, 1)) >= distributions).sum(axis=1)
+            sensor_readings[:, step] = numpy.minimum(readings, len(RobotModel.READINGS) - 1)
+
+        return {'ground_truth': ground_truth, 'actions': actions, 'sensor_readings': sensor_readings}
+
+    @classmethod
+    def decode_experiment(cls, experiments, index, robot_model=None):
+        """ground_truth_states, actions and sensor_readings of one generated experiment, as in import_experiment."""
+        robot_model = robot_model or RobotModel.DEFAULT
+        # the starting cell is written zero-based and the others one-based, as in the existing experiment files
+        (row, column), *path = experiments['ground_truth'][index].tolist()
+        ground_truth_states = [f'{row} {column}'] + [f'{row + 1} {column + 1}' for row, column in path]
+        actions = list(numpy.frombuffer(''.join(robot_model.actions).encode('ascii'), dtype=numpy.uint8)[
+            experiments['actions'][index]].tobytes().decode('ascii'))
+        sensor_readings = list(TerrainGrid.CHARACTERS[experiments['sensor_readings'][index]].tobytes().decode('ascii'))
+        return ground_truth_states, actions, sensor_readings
+
+    @classmethod
+    def generate_experiment(cls, grid, seed=None, robot_model=None):
+        """One 100-step experiment as in import_experiment.
+
+        This is generate_experiments for a single trajectory, drawing the same random numbers in the same order, but
+        stepping with Python scalars, which is faster than the array operations for one robot.
+        """
+        grid = TerrainGrid.from_rows(grid)
+        robot_model = robot_model or RobotModel.DEFAULT
+        random_generator = numpy.random.default_rng(seed)
+
+        rows, columns = Grid.sample_unblocked_cells(grid, 1, random_generator)
+        row, column = int(rows[0]), int(columns[0])
+        actions = [robot_model.actions[code]
+                   for code in random_generator.integers(0, len(robot_model.actions), 100, dtype=numpy.uint8).tolist()]
+        # a move and a sensor reading draw per step
+        draws = random_generator.uniform(0, 1, (100, 2)).tolist()
+        reading_distributions = numpy.cumsum(robot_model.sensor_matrix, axis=1).tolist()
+        # indexing a memoryview with Python ints is much cheaper than indexing the array
+        codes = memoryview(numpy.ascontiguousarray(grid.codes))
+        blocked = TerrainGrid.CODES[Grid.BLOCKED]
+
+        ground_truth_states = [f'{row} {column}']  # starting row and column, zero-based
         sensor_readings = []
-        for x in range(100):
-            # actions
-            action = random.choice([Grid.UP, Grid.DOWN, Grid.LEFT, Grid.RIGHT])
-            actions.append(action)
-
-            # ground truth states
-            num = random.uniform(0, 1)
-            if 0 <= num < 0.9:
-                match action:
-                    case Grid.UP:
-                        if row > 0 and grid[row - 1][column] != Grid.BLOCKED:
-                            row -= 1
-                    case Grid.DOWN:
-                        if row < rows - 1 and grid[row + 1][column] != Grid.BLOCKED:
-                            row += 1
-                    case Grid.LEFT:
-                        if column > 0 and grid[row][column - 1] != Grid.BLOCKED:
-                            column -= 1
-                    case Grid.RIGHT:
-                        if column < columns - 1 and grid[row][column + 1] != Grid.BLOCKED:
-                            column += 1
+        for action, (move_draw, reading_draw) in zip(actions, draws):
+            row_offset, column_offset = robot_model.moves[action]
+            next_row, next_column = row + row_offset, column + column_offset
+            if move_draw < robot_model.move_probability and 0 <= next_row < grid.rows \
+                    and 0 <= next_column < grid.columns and codes[next_row, next_column] != blocked:
+                row, column = next_row, next_column
             ground_truth_states.append(f'{row + 1} {column + 1}')
 
-            # sensor readings
-            num = random.uniform(0, 1)
-            if 0 <= num < 0.9:
-                sensor_reading = grid[row][column]
-            else:
-                sensor_reading = random.choice(
-                    [x for x in [Grid.NORMAL, Grid.HIGHWAY, Grid.HARD_TO_TRAVERSE] if x != grid[row][column]])
-            sensor_readings.append(sensor_reading)
+            reading = bisect.bisect_right(reading_distributions[codes[row, column]], reading_draw)
+            sensor_readings.append(RobotModel.READINGS[min(reading, len(RobotModel.READINGS) - 1)])
 
         return ground_truth_states, actions, sensor_readings
 
     @classmethod
-    def calculate_next_probabilities(cls, grid, actions, sensor_readings, start_step=0, end_step=0, probabilities=None):
-        rows, columns = len(grid), len(grid[0])
+    def generate_dataset(cls, num_grids, num_experiments, rows=100, columns=50, num_steps=100, seed=None,
+                         robot_model=None):
+        """num_grids random grids, each with the generate_experiments result of num_experiments trajectories."""
+        random_generator = numpy.random.default_rng(seed)
+        dataset = []
+        for x in range(num_grids):
+            grid = Grid.generate_grid(rows, columns, random_generator)
+            dataset.append((grid, Grid.generate_experiments(grid, num_experiments, num_steps, random_generator,
+                                                            robot_model)))
+        return dataset
+
+    @classmethod
+    def filter_model(cls, grid, robot_model=None):
+        """The filter kernel of robot_model (RobotModel.DEFAULT if None) on grid, built once and cached on the grid
+        with those of the other most recently used models (TerrainGrid.MAX_CACHED_MODELS)."""
+        grid = TerrainGrid.from_rows(grid)
+        robot_model = robot_model or RobotModel.DEFAULT
+        return grid.cached(('filter_model',) + robot_model.key,
+                           functools.partial(Grid.build_filter_model, robot_model=robot_model), robot_model.key)
+
+    @classmethod
+    def build_filter_model(cls, grid, robot_model=None):
+        grid = TerrainGrid.from_rows(grid)
+        robot_model = robot_model or RobotModel.DEFAULT
+        rows, columns = grid.rows, grid.columns
+        blocked = grid.blocked
+
+        # pad with blocked cells so the border behaves like a blocked neighbour; this does not depend on the robot
+        # model, so kernels of different models share it
+        unblocked = grid.cached('padded_unblocked', lambda g: numpy.pad(~g.blocked, 1, constant_values=False))
+
+        # stacked tables indexed by action code and reading (terrain) code for batched filtering; the per-action and
+        # per-reading entries are views of them
+        stay_table = numpy.empty((len(robot_model.actions), rows, columns))
+        arrive_table = numpy.empty((len(robot_model.actions), rows, columns))
+        transitions = {}
+        for code, action in enumerate(robot_model.actions):
+            row_offset, column_offset = robot_model.moves[action]
+            stay_table[code], arrive_table[code], source = Grid.transition_coefficients(
+                unblocked, row_offset, column_offset, robot_model.move_probability)
+            transitions[action] = (stay_table[code], arrive_table[code], source)
+
+        # probability of each reading on every cell; a blocked reading is never made and is equally likely everywhere
+        likelihood_table = numpy.full((len(TerrainGrid.TERRAINS), rows, columns), 0.05)
+        for code, reading in enumerate(RobotModel.READINGS):
+            likelihood_table[TerrainGrid.CODES[reading]] = robot_model.terrain_likelihoods[grid.codes, code]
+        likelihoods = {reading: likelihood_table[TerrainGrid.CODES[reading]] for reading in RobotModel.READINGS}
+
+        return {
+            'shape': (rows, columns),
+            'blocked': blocked,
+            'actions': robot_model.actions,
+            'transitions': transitions,
+            'likelihoods': likelihoods,
+            'stay_table': stay_table,
+            'arrive_table': arrive_table,
+            'likelihood_table': likelihood_table,
+        }
+
+    @classmethod
+    def transition_coefficients(cls, unblocked, row_offset, column_offset, move_probability):
+        """(coefficient of staying at the current cell, coefficient of arriving from the source cell, offset of the
+        source cell) of a move by (row_offset, column_offset), for the cells inside the one-cell border of the open
+        cell mask unblocked (the last two axes; any leading axes stack several windows).
+
+        The robot stays if the move fails or its destination is blocked or off the grid. Blocked cells are never
+        updated by the motion model, so they stay with coefficient 1.
+        """
+        rows, columns = unblocked.shape[-2] - 2, unblocked.shape[-1] - 2
+
+        def neighbour(r, c):
+            return unblocked[..., 1 + r:1 + r + rows, 1 + c:1 + c + columns]
+
+        blocked = ~neighbour(0, 0)
+        if not (row_offset or column_offset):
+            # a stay action ends in the same cell whether or not the move succeeds; splitting the self-transition
+            # into a stay and an arrival term would make viterbi take the larger of the two instead of their sum
+            return numpy.ones(blocked.shape), numpy.zeros(blocked.shape), (0, 0)
+        stay = numpy.where(neighbour(row_offset, column_offset), 1 - move_probability, 1.0)
+        arrive = numpy.where(neighbour(-row_offset, -column_offset), move_probability, 0.0)
+        return numpy.where(blocked, 1.0, stay), numpy.where(blocked, 0.0, arrive), (-row_offset, -column_offset)
+
+    @classmethod
+    def initial_probabilities(cls, model):
+        blocked = model['blocked']
+        num_unblocked_cells = blocked.size - numpy.count_nonzero(blocked)
+        return numpy.where(blocked, 0, 1 / num_unblocked_cells)
 
-        if not probabilities:
-            num_unblocked_cells = rows * columns - sum(r.count('B') for r in grid)
-            probabilities = [[1 / num_unblocked_cells if grid[r][c] != 'B' else 0 for c in range(columns)] for r in
-                             range(rows)]
+    @classmethod
+    def predict(cls, model, probabilities, padded, action):
+        rows, columns = model['shape']
+        stay, arrive, (row_offset, column_offset) = model['transitions'][action]
+
+        padded[1:-1, 1:-1] = probabilities
+        source = padded[1 + row_offset:1 + row_offset + rows, 1 + column_offset:1 + column_offset + columns]
+        moved = arrive * source
+        probabilities *= stay
+        probabilities += moved
+        return probabilities
+
+    @classmethod
+    def filter_step(cls, model, probabilities, padded, action, sensor_reading):
+        # actions
+        Grid.predict(model, probabilities, padded, action)
+
+        # sensor readings
+        probabilities *= model['likelihoods'].get(sensor_reading, 0.05)
+
+        return Grid.normalize(probabilities)
+
+    @classmethod
+    def profiled_filter_step(cls, model, probabilities, padded, action, sensor_reading, metrics):
+        """filter_step (or batch_filter_step for a K x rows x columns belief and code arrays) reporting the time of
+        each phase, the normalizer and the belief to metrics."""
+        start = time.perf_counter()
+        if probabilities.ndim == 3:
+            Grid.batch_predict(model, probabilities, padded, action)
+            predicted = time.perf_counter()
+            probabilities *= model['likelihood_table'][sensor_reading]
+        else:
+            Grid.predict(model, probabilities, padded, action)
+            predicted = time.perf_counter()
+            probabilities *= model['likelihoods'].get(sensor_reading, 0.05)
+        corrected = time.perf_counter()
+        normalizer = Grid.normalizer(probabilities)
+        probabilities /= numpy.asarray(normalizer)[..., None, None]
+        normalized = time.perf_counter()
+
+        timings = {'predict': predicted - start, 'sensor': corrected - predicted, 'normalize': normalized - corrected}
+        metrics.step(timings, normalizer, probabilities)
+        return probabilities
+
+    @classmethod
+    def normalizer(cls, probabilities):
+        # accumulate row by row so the sum matches the sequential Python sum bit for bit
+        return numpy.cumsum(numpy.cumsum(probabilities, axis=-1)[..., -1], axis=-1)[..., -1]
+
+    @classmethod
+    def normalize(cls, probabilities):
+        probabilities /= numpy.asarray(Grid.normalizer(probabilities))[..., None, None]
+        return probabilities
+
+    @classmethod
+    def encode_actions(cls, actions, robot_model=None):
+        names = (robot_model or RobotModel.DEFAULT).actions
+        lookup = numpy.full(256, len(names), dtype=numpy.uint8)
+        lookup[numpy.frombuffer(''.join(names).encode('ascii'), dtype=numpy.uint8)] = numpy.arange(len(names))
+        codes = numpy.array([lookup[numpy.frombuffer(''.join(a).encode('ascii'), dtype=numpy.uint8)] for a in actions])
+        if numpy.any(codes == len(names)):
+            raise Exception("Unknown action")
+        return codes
+
+    @classmethod
+    def parse_ground_truth_locations(cls, ground_truth_states):
+        """Zero-based cells of ground truth states; the starting cell is written zero-based and the others one-based."""
+        locations = numpy.array([[int(x) for x in state.split()] for state in ground_truth_states],
+                                dtype=numpy.intp).reshape(-1, 2)
+        locations[1:] -= 1
+        return locations
+
+    @classmethod
+    def batch_predict(cls, model, probabilities, padded, action_codes):
+        rows, columns = model['shape']
+
+        # actions: gather each experiment's source cells, grouped by action so every shift is one slice
+        padded[:, 1:-1, 1:-1] = probabilities
+        moved = numpy.empty_like(probabilities)
+        for code, action in enumerate(model['actions']):
+            selected = action_codes == code
+            if not selected.any():
+                continue
+            row_offset, column_offset = model['transitions'][action][2]
+            moved[selected] = padded[selected, 1 + row_offset:1 + row_offset + rows,
+                                     1 + column_offset:1 + column_offset + columns]
+        moved *= model['arrive_table'][action_codes]
+        probabilities *= model['stay_table'][action_codes]
+        probabilities += moved
+        return probabilities
+
+    @classmethod
+    def batch_filter_step(cls, model, probabilities, padded, action_codes, reading_codes):
+        Grid.batch_predict(model, probabilities, padded, action_codes)
+
+        # sensor readings
+        probabilities *= model['likelihood_table'][reading_codes]
+
+        return Grid.normalize(probabilities)
+
+    @classmethod
+    def calculate_batch_probabilities(cls, grid, actions, sensor_readings, start_step=0, end_step=0,
+                                      probabilities=None, ground_truth_locations=None, metrics=None, robot_model=None):
+        """Filter K experiments on the same grid together.
+
+        actions and sensor_readings hold one sequence per experiment (or are K x steps uint8 code arrays),
+        probabilities is an optional K x rows x columns belief to resume from and ground_truth_locations is an
+        optional K x (steps + 1) x 2 array of zero-based (row, column) positions laid out as generate_experiments'
+        'ground_truth', starting with the initial cell, so the belief after action i is read at position i + 1.
+
+        Returns the K x rows x columns belief after end_step, the (row, column) of each experiment's most likely
+        cell after every step in [start_step, end_step) as a K x (end_step - start_step) x 2 array, and the belief
+        at the ground truth location after every step (None without ground_truth_locations). With metrics (a
+        FilterMetrics) every step is profiled.
+        """
+        grid = TerrainGrid.from_rows(grid)
+        model = Grid.filter_model(grid, robot_model)
+        rows, columns = model['shape']
+        num_experiments = len(actions)
+
+        # uint8 code arrays, as stored by generate_experiments and save_experiments, are used without re-encoding
+        if isinstance(actions, numpy.ndarray) and actions.dtype == numpy.uint8:
+            action_codes = actions[:, start_step:end_step]
+        else:
+            action_codes = Grid.encode_actions([a[start_step:end_step] for a in actions], robot_model)
+        if isinstance(sensor_readings, numpy.ndarray) and sensor_readings.dtype == numpy.uint8:
+            reading_codes = sensor_readings[:, start_step:end_step]
+        else:
+            reading_codes = TerrainGrid.encode(''.join(''.join(s[start_step:end_step]) for s in sensor_readings))
+            reading_codes = reading_codes.reshape(num_experiments, end_step - start_step)
+
+        if probabilities is None or len(probabilities) == 0:
+            probabilities = numpy.repeat(Grid.initial_probabilities(model)[None], num_experiments, axis=0)
+        else:
+            probabilities = numpy.array(probabilities, dtype=float)
+
+        experiments = numpy.arange(num_experiments)
+        maximum_locations = numpy.zeros((num_experiments, end_step - start_step, 2), dtype=numpy.intp)
+        ground_truth_probabilities = None
+        if ground_truth_locations is not None:
+            ground_truth_locations = numpy.asarray(ground_truth_locations)
+            ground_truth_probabilities = numpy.zeros((num_experiments, end_step - start_step))
+
+        padded = numpy.zeros((num_experiments, rows + 2, columns + 2))
+        filter_step = Grid.batch_filter_step
+        if metrics is not None:
+            filter_step = functools.partial(Grid.profiled_filter_step, metrics=metrics)
+
+        for i in range(end_step - start_step):
+            filter_step(model, probabilities, padded, action_codes[:, i], reading_codes[:, i])
+
+            maximum = probabilities.reshape(num_experiments, -1).argmax(axis=1)
+            maximum_locations[:, i, 0], maximum_locations[:, i, 1] = numpy.divmod(maximum, columns)
+            if ground_truth_locations is not None:
+                gr, gc = ground_truth_locations[:, start_step + i + 1].T
+                ground_truth_probabilities[:, i] = probabilities[experiments, gr, gc]
+
+        return probabilities, maximum_locations, ground_truth_probabilities
+
+    @classmethod
+    def backward_step(cls, model, beliefs, padded, action, sensor_reading):
+        rows, columns = model['shape']
+        stay, arrive, (row_offset, column_offset) = model['transitions'][action]
+
+        # sensor readings
+        weighted = beliefs * model['likelihoods'].get(sensor_reading, 0.05)
+
+        # actions: transpose of the motion model, the source cell receives what arrives at the cell it moved to
+        padded[1:-1, 1:-1] = arrive * weighted
+        arrived = padded[1 - row_offset:1 - row_offset + rows, 1 - column_offset:1 - column_offset + columns]
+        weighted *= stay
+        weighted += arrived
+
+        # rescale so long experiments do not underflow, smoothing only needs the shape
+        weighted /= weighted.sum()
+        return weighted
+
+    @classmethod
+    def smooth_probabilities(cls, grid, actions, sensor_readings, steps=None, checkpoint_interval=None,
+                             robot_model=None):
+        """Forward-backward smoothing, P(x_t | all evidence), for the given steps (every step by default).
+
+        Forward beliefs are stored every checkpoint_interval steps (about sqrt(len(actions)) by default, 1 stores all
+        of them) and the segment between two checkpoints is recomputed during the backward pass. Returning every step
+        holds a belief per step anyway, so checkpointing needs the steps to return; without steps every forward
+        belief is stored.
+
+        Returns a dict from step to smoothed belief and the peak number of bytes held by stored forward and backward
+        beliefs and the smoothed beliefs returned.
+        """
+        grid = TerrainGrid.from_rows(grid)
+        model = Grid.filter_model(grid, robot_model)
+        rows, columns = model['shape']
+        num_steps = len(actions)
+        if steps is None:
+            if checkpoint_interval not in (None, 1):
+                raise Exception("Checkpointed smoothing needs the steps to return")
+            steps, checkpoint_interval = range(num_steps + 1), 1
+        steps = set(steps)
+        if checkpoint_interval is None:
+            checkpoint_interval = max(1, math.isqrt(num_steps))
+        belief_bytes = rows * columns * numpy.dtype(float).itemsize
+        padded = numpy.zeros((rows + 2, columns + 2))
+
+        # forward pass, keeping only the checkpoints
+        probabilities = Grid.initial_probabilities(model)
+        checkpoints = {0: probabilities.copy()}
+        for i in range(num_steps):
+            Grid.filter_step(model, probabilities, padded, actions[i], sensor_readings[i])
+            if (i + 1) % checkpoint_interval == 0 and i + 1 < num_steps:
+                checkpoints[i + 1] = probabilities.copy()
+        peak_memory = (len(checkpoints) + 1) * belief_bytes
+
+        # backward pass, one checkpoint segment at a time from the end
+        smoothed = {}
+        beliefs = numpy.ones((rows, columns))
+        for start in sorted(checkpoints, reverse=True):
+            end = min(start + checkpoint_interval, num_steps)
+            segment = [checkpoints[start].copy()]
+            for i in range(start, end):
+                segment.append(Grid.filter_step(model, segment[-1].copy(), padded, actions[i], sensor_readings[i]))
+
+            for step in range(end, start - 1, -1):
+                # the last step of a segment was already handled as the first step of the next one
+                if step == end and end != num_steps:
+                    continue
+                if step in steps:
+                    smoothed[step] = Grid.normalize(segment[step - start] * beliefs)
+                if step > 0:
+                    beliefs = Grid.backward_step(model, beliefs, padded, actions[step - 1], sensor_readings[step - 1])
+            peak_memory = max(peak_memory, (len(checkpoints) + len(segment) + 1 + len(smoothed)) * belief_bytes)
+            del checkpoints[start]
+
+        return smoothed, peak_memory
+
+    @classmethod
+    def viterbi(cls, grid, actions, sensor_readings, robot_model=None):
+        """Most likely sequence of cells given the actions and sensor readings.
+
+        Returns the path as zero-based (row, column) tuples, starting with the initial cell, and its log probability.
+        """
+        grid = TerrainGrid.from_rows(grid)
+        model = Grid.filter_model(grid, robot_model)
+        rows, columns = model['shape']
+
+        with numpy.errstate(divide='ignore'):
+            log_probabilities = numpy.log(Grid.initial_probabilities(model))
+            log_stay = {action: numpy.log(t[0]) for action, t in model['transitions'].items()}
+            log_arrive = {action: numpy.log(t[1]) for action, t in model['transitions'].items()}
+            log_likelihoods = {reading: numpy.log(l) for reading, l in model['likelihoods'].items()}
+
+        # backpointers: 0 if the robot stayed in the cell, otherwise 1 + the code of the action that moved it there
+        backpointers = numpy.zeros((len(actions), rows, columns), dtype=numpy.uint8)
+        padded = numpy.full((rows + 2, columns + 2), -numpy.inf)
+        for i, action in enumerate(actions):
+            row_offset, column_offset = model['transitions'][action][2]
+            padded[1:-1, 1:-1] = log_probabilities
+            arrived = padded[1 + row_offset:1 + row_offset + rows, 1 + column_offset:1 + column_offset + columns]
+            arrived = arrived + log_arrive[action]
+            log_probabilities += log_stay[action]
+
+            moved = arrived > log_probabilities
+            backpointers[i][moved] = 1 + model['actions'].index(action)
+            numpy.copyto(log_probabilities, arrived, where=moved)
+
+            log_probabilities += log_likelihoods.get(sensor_readings[i], numpy.log(0.05))
+
+        row, column = numpy.unravel_index(numpy.argmax(log_probabilities), (rows, columns))
+        log_probability = log_probabilities[row, column]
+        path = [(int(row), int(column))]
+        for i in range(len(actions) - 1, -1, -1):
+            code = backpointers[i, row, column]
+            if code:
+                row_offset, column_offset = model['transitions'][model['actions'][code - 1]][2]
+                row, column = row + row_offset, column + column_offset
+            path.append((int(row), int(column)))
+        path.reverse()
+
+        return path, float(log_probability)
+
+    @classmethod
+    def build_transition_operators(cls, grid, robot_model=None):
+        from scipy import sparse
+
+        grid = TerrainGrid.from_rows(grid)
+        model = Grid.filter_model(grid, robot_model)
+        rows, columns = model['shape']
+        cells = numpy.arange(rows * columns).reshape(rows, columns)
+
+        # row i of an operator holds the probabilities of arriving at cell i from every cell
+        operators = {}
+        for action, (stay, arrive, (row_offset, column_offset)) in model['transitions'].items():
+            has_source = arrive > 0
+            operator = sparse.csr_matrix(
+                (numpy.concatenate([stay.ravel(), arrive[has_source]]),
+                 (numpy.concatenate([cells.ravel(), cells[has_source]]),
+                  numpy.concatenate([cells.ravel(), cells[has_source] + row_offset * columns + column_offset]))),
+                shape=(rows * columns, rows * columns))
+            operator.eliminate_zeros()
+            operators[action] = operator
+
+        return {
+            'shape': (rows, columns),
+            'blocked': model['blocked'],
+            'operators': operators,
+            'likelihoods': {reading: likelihood.ravel() for reading, likelihood in model['likelihoods'].items()},
+        }
+
+    @classmethod
+    def sparse_filter_step(cls, operators, probabilities, action, sensor_reading):
+        probabilities = operators['operators'][action] @ probabilities
+        probabilities *= operators['likelihoods'].get(sensor_reading, 0.05)
+        Grid.normalize(probabilities.reshape(operators['shape']))
+        return probabilities
+
+    @classmethod
+    def calculate_next_probabilities(cls, grid, actions, sensor_readings, start_step=0, end_step=0, probabilities=None,
+                                     backend='dense', metrics=None, robot_model=None):
+        if backend not in ('dense', 'sparse'):
+            raise Exception("Unknown backend")
+        grid = TerrainGrid.from_rows(grid)
+        model = Grid.filter_model(grid, robot_model)
+        rows, columns = model['shape']
+
+        if probabilities is None or len(probabilities) == 0:
+            probabilities = Grid.initial_probabilities(model)
+        else:
+            probabilities = numpy.array(probabilities, dtype=float)
 
         # len(actions) == len(sensor_readings)
+        if backend == 'sparse':
+            if metrics is not None:
+                raise Exception("Metrics are only recorded by the dense backend")
+            robot_model = robot_model or RobotModel.DEFAULT
+            operators = grid.cached(('transition_operators',) + robot_model.key,
+                                    functools.partial(Grid.build_transition_operators, robot_model=robot_model),
+                                    robot_model.key)
+            probabilities = probabilities.ravel()
+            for i in range(start_step, end_step):
+                probabilities = Grid.sparse_filter_step(operators, probabilities, actions[i], sensor_readings[i])
+            return probabilities.reshape(rows, columns)
+
+        filter_step = Grid.filter_step
+        if metrics is not None:
+            filter_step = functools.partial(Grid.profiled_filter_step, metrics=metrics)
+
+        padded = numpy.zeros((rows + 2, columns + 2))
         for i in range(start_step, end_step):
+            filter_step(model, probabilities, padded, actions[i], sensor_readings[i])
 
-            # use previous probabilities for current step
-            prev_probabilities = [r[:] for r in probabilities]
-
-            # actions
-            for row in range(rows):
-                for column in range(columns):
-                    if grid[row][column] == Grid.BLOCKED:
-                        continue
-                    probabilities[row][column] = 0
-                    match actions[i]:
-                        # Failed to move to next cell from current cell (fails)
-                        # Stays at current cell, but didn't fail (blocked or at border)
-                        # Move to current cell from previous cell (success)
-                        case Grid.UP:
-                            # Failed to move to next cell from current cell (fails)
-                            if row > 0 and grid[row - 1][column] != Grid.BLOCKED:
-                                probabilities[row][column] += 0.1 * prev_probabilities[row][column]
-                            # Stays at current cell, but didn't fail (blocked or at border)
-                            else:
-                                probabilities[row][column] += prev_probabilities[row][column]
-
-                            # Move to current cell from previous cell (success)
-                            if row < rows - 1 and grid[row + 1][column] != Grid.BLOCKED:
-                                probabilities[row][column] += 0.9 * prev_probabilities[row + 1][column]
-
-                        case Grid.DOWN:
-                            # Failed to move to next cell from current cell (fails)
-                            if row < rows - 1 and grid[row + 1][column] != Grid.BLOCKED:
-                                probabilities[row][column] += 0.1 * prev_probabilities[row][column]
-
-                            # Move to current cell from previous cell (success)
-                            if row > 0 and grid[row - 1][column] != Grid.BLOCKED:
-                                probabilities[row][column] += 0.9 * prev_probabilities[row - 1][column]
-
-                        case Grid.LEFT:
-                            # Failed to move to next cell from current cell (fails)
-                            if column > 0 and grid[row][column - 1] != Grid.BLOCKED:
-                                probabilities[row][column] += 0.1 * prev_probabilities[row][column]
-                            else:
-                                probabilities[row][column] += prev_probabilities[row][column]
-                            # Move to current cell from previous cell (success)
-                            if column < columns - 1 and grid[row][column + 1] != Grid.BLOCKED:
-                                probabilities[row][column] += 0.9 * prev_probabilities[row][column + 1]
-
-                        case Grid.RIGHT:
-                            # Failed to move to next cell from current cell (fails)
-                            if column < columns - 1 and grid[row][column + 1] != Grid.BLOCKED:
-                                probabilities[row][column] += 0.1 * prev_probabilities[row][column]
-                            else:
-                                probabilities[row][column] += prev_probabilities[row][column]
-                            # Move to current cell from previous cell (success)
-                            if column > 0 and grid[row][column - 1] != Grid.BLOCKED:
-                                probabilities[row][column] += 0.9 * prev_probabilities[row][column - 1]
-
-            # sensor readings
-            for row in range(rows):
-                for column in range(columns):
-                    if grid[row][column] != 'B' and grid[row][column] == sensor_readings[i]:
-                        probabilities[row][column] *= 0.9
-                    else:
-                        probabilities[row][column] *= 0.05
-
-            # normalization
-            sum_probabilities = sum(sum(r) for r in probabilities)
-            for row in range(rows):
-                for column in range(columns):
-                    probabilities[row][column] /= sum_probabilities
+        return probabilities
 
+    @classmethod
+    def calculate_log_likelihood(cls, grid, actions, sensor_readings, start_step=0, end_step=0, probabilities=None,
+                                 robot_model=None):
+        """Filter like calculate_next_probabilities, accumulating the log of every step's normalizer.
+
+        The normalizer of a step is the probability of its sensor reading given the actions and readings before it,
+        so the sum is the log-likelihood of the readings in [start_step, end_step) under the grid and the starting
+        belief. probabilities may be a K x rows x columns stack of candidate starting beliefs (see
+        region_probabilities), which are all filtered along the same trajectory at once.
+
+        Returns the belief after end_step and the log-likelihood (a length K array for stacked beliefs).
+        """
+        grid = TerrainGrid.from_rows(grid)
+        model = Grid.filter_model(grid, robot_model)
+        rows, columns = model['shape']
+
+        if probabilities is None or len(probabilities) == 0:
+            probabilities = Grid.initial_probabilities(model)
+        else:
+            probabilities = numpy.array(probabilities, dtype=float)
+
+        padded = numpy.zeros(probabilities.shape[:-2] + (rows + 2, columns + 2))
+        log_likelihood = numpy.zeros(probabilities.shape[:-2])
+        for i in range(start_step, end_step):
+            if probabilities.ndim == 3:
+                action_codes = numpy.full(len(probabilities), model['actions'].index(actions[i]))
+                Grid.batch_predict(model, probabilities, padded, action_codes)
+            else:
+                Grid.predict(model, probabilities, padded, actions[i])
+            probabilities *= model['likelihoods'].get(sensor_readings[i], 0.05)
+
+            normalizer = Grid.normalizer(probabilities)
+            probabilities /= numpy.asarray(normalizer)[..., None, None]
+            log_likelihood += numpy.log(normalizer)
+
+        return probabilities, log_likelihood if probabilities.ndim == 3 else float(log_likelihood)
+
+    @classmethod
+    def region_probabilities(cls, grid, regions):
+        """Uniform starting beliefs over the unblocked cells of each region, as a K x rows x columns stack.
+
+        A region is a rows x columns boolean mask or a (top, left, bottom, right) box with exclusive bottom and right.
+        """
+        grid = TerrainGrid.from_rows(grid)
+        probabilities = numpy.zeros((len(regions), grid.rows, grid.columns))
+        for probability, region in zip(probabilities, regions):
+            if isinstance(region, tuple):
+                top, left, bottom, right = region
+                probability[top:bottom, left:right] = 1
+            else:
+                probability[numpy.asarray(region, dtype=bool)] = 1
+            probability[grid.blocked] = 0
+            if not probability.any():
+                raise Exception("Region has no unblocked cells")
+            probability /= probability.sum()
         return probabilities
 
+    @classmethod
+    def rank_start_regions(cls, grid, actions, sensor_readings, regions, robot_model=None):
+        """(region index, log-likelihood) of every candidate start region, most likely first."""
+        _, log_likelihoods = Grid.calculate_log_likelihood(grid, actions, sensor_readings, 0, len(actions),
+                                                           Grid.region_probabilities(grid, regions), robot_model)
+        order = numpy.argsort(-log_likelihoods, kind='stable')
+        return [(int(index), float(log_likelihoods[index])) for index in order]
+
+    @classmethod
+    def rank_grids(cls, grids, actions, sensor_readings, margin=30.0, prune_interval=10, robot_model=None):
+        """Score one trajectory against many candidate grids, most likely first.
+
+        Grids are bucketed by shape and every bucket is filtered as one stacked array, accumulating each grid's
+        log-likelihood as in calculate_log_likelihood. Every prune_interval steps and after the last step the grids
+        whose log-likelihood is more than margin below the best are dropped; their log-likelihood is the one at the
+        step they were dropped, an upper bound of the full one, and they are ranked after the grids that were kept.
+
+        Returns (grid index, log-likelihood, step the grid was dropped at or None) for every grid.
+        """
+        grids = [TerrainGrid.from_rows(grid) for grid in grids]
+        buckets = collections.defaultdict(list)
+        for index, grid in enumerate(grids):
+            buckets[(grid.rows, grid.columns)].append(index)
+
+        stacks = []
+        for (rows, columns), indices in buckets.items():
+            models = [Grid.filter_model(grids[index], robot_model) for index in indices]
+            stacks.append({
+                'shape': (rows, columns),
+                'indices': numpy.array(indices),
+                'stay': numpy.stack([model['stay_table'] for model in models]),
+                'arrive': numpy.stack([model['arrive_table'] for model in models]),
+                'likelihood': numpy.stack([model['likelihood_table'] for model in models]),
+                'offsets': [models[0]['transitions'][action][2] for action in models[0]['actions']],
+                'probabilities': numpy.stack([Grid.initial_probabilities(model) for model in models]),
+                'padded': numpy.zeros((len(indices), rows + 2, columns + 2)),
+                'log_likelihood': numpy.zeros(len(indices)),
+            })
+
+        dropped = []
+        for i in range(len(actions)):
+            action_code = (robot_model or RobotModel.DEFAULT).actions.index(actions[i])
+            reading_code = TerrainGrid.TERRAINS.index(sensor_readings[i])
+            for stack in stacks:
+                rows, columns = stack['shape']
+                row_offset, column_offset = stack['offsets'][action_code]
+                probabilities, padded = stack['probabilities'], stack['padded']
+
+                # filter_step over the stacked grids, with each grid's own coefficients
+                padded[:, 1:-1, 1:-1] = probabilities
+                moved = stack['arrive'][:, action_code] * padded[:, 1 + row_offset:1 + row_offset + rows,
+                                                                 1 + column_offset:1 + column_offset + columns]
+                probabilities *= stack['stay'][:, action_code]
+                probabilities += moved
+                probabilities *= stack['likelihood'][:, reading_code]
+
+                normalizer = Grid.normalizer(probabilities)
+                probabilities /= normalizer[:, None, None]
+                stack['log_likelihood'] += numpy.log(normalizer)
+
+            if (i + 1) % prune_interval == 0 and i + 1 < len(actions):
+                best = max(stack['log_likelihood'].max() for stack in stacks)
+                for stack in stacks:
+                    keep = stack['log_likelihood'] >= best - margin
+                    dropped += [(int(index), float(log_likelihood), i + 1) for index, log_likelihood
+                                in zip(stack['indices'][~keep], stack['log_likelihood'][~keep])]
+                    for key in ['indices', 'stay', 'arrive', 'likelihood', 'probabilities', 'padded',
+                                'log_likelihood']:
+                        stack[key] = stack[key][keep]
+                stacks = [stack for stack in stacks if len(stack['indices'])]
+
+        completed = [(int(index), float(log_likelihood), None) for stack in stacks
+                     for index, log_likelihood in zip(stack['indices'], stack['log_likelihood'])]
+        return Grid.order_ranking(completed + dropped, margin, len(actions))
+
+    @classmethod
+    def order_ranking(cls, ranking, margin, num_steps):
+        """Sort (grid, log-likelihood, step dropped at or None) candidates, most likely first, after dropping the grids
+        filtered to the end that are more than margin below the best of them at the last step."""
+        best = max((log_likelihood for _, log_likelihood, dropped in ranking if dropped is None), default=None)
+        ranking = [(grid, log_likelihood, num_steps)
+                   if dropped is None and log_likelihood < best - margin else (grid, log_likelihood, dropped)
+                   for grid, log_likelihood, dropped in ranking]
+        return sorted(ranking, key=lambda c: (c[2] is not None, -c[1]))
+
+
+class TerrainGrid:
+    """Grid stored as a uint8 array of terrain codes with precomputed per-terrain masks.
+
+    Rows index as strings, so ``grid[row][column]``, ``len(grid)`` and ``len(grid[0])`` behave like the
+    list-of-lists grids used elsewhere.
+    """
+    TERRAINS = (Grid.NORMAL, Grid.HIGHWAY, Grid.HARD_TO_TRAVERSE, Grid.BLOCKED)
+    CODES = {terrain: code for code, terrain in enumerate(TERRAINS)}
+    CHARACTERS = numpy.frombuffer(''.join(TERRAINS).encode('ascii'), dtype=numpy.uint8)
+    LOOKUP = numpy.full(256, len(TERRAINS), dtype=numpy.uint8)
+    LOOKUP[CHARACTERS] = numpy.arange(len(TERRAINS))
+    # cache entries of at most this many robot models are kept per grid, the most recently used ones
+    MAX_CACHED_MODELS = 4
+
+    def __init__(self, codes):
+        self.codes = numpy.asarray(codes, dtype=numpy.uint8)
+        if self.codes.ndim != 2:
+            raise Exception("Terrain codes must be a 2D array")
+        self.rows, self.columns = self.codes.shape
+        self.masks = {terrain: self.codes == code for terrain, code in TerrainGrid.CODES.items()}
+        self.blocked = self.masks[Grid.BLOCKED]
+        # per-grid precomputations (filter models, transition operators, ...); terrain codes are never modified
+        self.cache = {}
+        # cache keys of the entries built for every robot model key, least recently used first
+        self.model_keys = collections.OrderedDict()
+
+    def cached(self, key, build, model_key=None):
+        """self.cache[key], built by build(self) on first use. Entries built for a robot model pass its key as
+        model_key, so the entries of the least recently used models can be evicted; sweeps over model parameters
+        would otherwise keep a kernel per model."""
+        if model_key is not None:
+            self.model_keys.setdefault(model_key, set()).add(key)
+            self.model_keys.move_to_end(model_key)
+            while len(self.model_keys) > TerrainGrid.MAX_CACHED_MODELS:
+                for evicted in self.model_keys.popitem(last=False)[1]:
+                    self.cache.pop(evicted, None)
+        if key not in self.cache:
+            self.cache[key] = build(self)
+        return self.cache[key]
+
+    @classmethod
+    def encode(cls, terrains):
+        codes = TerrainGrid.LOOKUP[numpy.frombuffer(terrains.encode('ascii'), dtype=numpy.uint8)]
+        if numpy.any(codes == len(TerrainGrid.TERRAINS)):
+            raise Exception("Unknown terrain")
+        return codes
+
+    @classmethod
+    def from_rows(cls, grid):
+        if isinstance(grid, TerrainGrid):
+            return grid
+        rows, columns = len(grid), len(grid[0])
+        terrains = ''.join(''.join(row) for row in grid)
+        if len(terrains) != rows * columns:
+            raise Exception("Grid rows must contain one terrain per cell")
+        return TerrainGrid(TerrainGrid.encode(terrains).reshape(rows, columns))
+
+    def tolist(self):
+        return [list(row) for row in self]
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, row):
+        return TerrainGrid.CHARACTERS[self.codes[row]].tobytes().decode('ascii')
+
+    def __iter__(self):
+        for row in range(self.rows):
+            yield self[row]
+
+    def __eq__(self, other):
+        try:
+            other = TerrainGrid.from_rows(other)
+        except Exception:
+            return NotImplemented
+        return numpy.array_equal(self.codes, other.codes)
+
+
+class RobotModel:
+    """Motion and sensor model shared by the simulator (Grid.generate_experiments) and the filters.
+
+    An action moves the robot by its (row, column) offset in moves with probability move_probability and otherwise
+    leaves it in place, as does a move onto a blocked cell or off the grid. Offsets may be diagonal or (0, 0) for a
+    stay action; the default moves are Grid.MOVES. sensor_matrix[t][r] is the probability of reading terrain
+    READINGS[r] on a cell of terrain READINGS[t].
+
+    Models are compared by key, so the per-grid kernels built by Grid.filter_model are shared by equal models.
+    """
+    READINGS = (Grid.NORMAL, Grid.HIGHWAY, Grid.HARD_TO_TRAVERSE)
+
+    def __init__(self, move_probability=0.9, sensor_matrix=None, moves=None):
+        if sensor_matrix is None:
+            sensor_matrix = [[0.9, 0.05, 0.05], [0.05, 0.9, 0.05], [0.05, 0.05, 0.9]]
+        self.move_probability = move_probability
+        self.sensor_matrix = numpy.array(sensor_matrix, dtype=float)
+        self.moves = dict(Grid.MOVES if moves is None else moves)
+        self.actions = tuple(self.moves)
+
+        if not 0 <= move_probability <= 1:
+            raise Exception("Move probability must be between 0 and 1")
+        if self.sensor_matrix.shape != (3, 3) or not numpy.allclose(self.sensor_matrix.sum(axis=1), 1):
+            raise Exception("Sensor matrix must be 3 x 3 with rows summing to 1")
+        if any(len(action) != 1 for action in self.actions):
+            raise Exception("Actions must be single characters")
+        if any(abs(row_offset) > 1 or abs(column_offset) > 1 for row_offset, column_offset in self.moves.values()):
+            raise Exception("Moves must be to a neighbouring cell")
+
+        # probability of each reading on a cell of each terrain code; blocked cells never hold probability
+        self.terrain_likelihoods = numpy.vstack([self.sensor_matrix, numpy.zeros(len(RobotModel.READINGS))])
+        self.key = (move_probability, self.sensor_matrix.tobytes(), tuple(self.moves.items()))
+
+
+RobotModel.DEFAULT = RobotModel()
+
+
+class BeliefCache:
+    """LRU cache of filtered beliefs keyed by (grid id, experiment id, step).
+
+    A snapshot is kept every snapshot_interval steps and any other step is replayed forward from the nearest cached
+    step before it. Least recently used beliefs are evicted once they use more than memory_budget bytes.
+    """
+
+    def __init__(self, snapshot_interval=10, memory_budget=256 * 1024 * 1024):
+        self.snapshot_interval = snapshot_interval
+        self.memory_budget = memory_budget
+        self.memory = 0
+        self.beliefs = collections.OrderedDict()
+        # sequence log-likelihoods of the beliefs cached while profiling, so metrics restart from the right step
+        self.log_likelihoods = {}
+
+    def get(self, grid, actions, sensor_readings, step, grid_id=None, experiment_id=None, metrics=None):
+        if grid_id is None:
+            grid_id = id(grid)
+        if experiment_id is None:
+            experiment_id = (''.join(actions), ''.join(sensor_readings))
+
+        key = (grid_id, experiment_id, step)
+        if key in self.beliefs:
+            self.beliefs.move_to_end(key)
+            if metrics is not None:
+                metrics.start(self.log_likelihoods.get(key, math.nan))
+            return self.beliefs[key]
+
+        # replay forward from the nearest cached step, storing snapshots along the way
+        cached_steps = [s for g, e, s in self.beliefs if g == grid_id and e == experiment_id and s < step]
+        current = max(cached_steps, default=0)
+        probabilities = self.beliefs.get((grid_id, experiment_id, current))
+        if probabilities is None:
+            probabilities = self.put(key[:2] + (0,), Grid.calculate_next_probabilities(grid, actions, sensor_readings),
+                                     0.0)
+        if metrics is not None:
+            metrics.start(self.log_likelihoods.get(key[:2] + (current,), math.nan))
+        while current < step:
+            next_step = min((current // self.snapshot_interval + 1) * self.snapshot_interval, step)
+            probabilities = Grid.calculate_next_probabilities(grid, actions, sensor_readings, current, next_step,
+                                                              probabilities, metrics=metrics)
+            current = next_step
+            if current % self.snapshot_interval == 0 or current == step:
+                self.put(key[:2] + (current,), probabilities, metrics.log_likelihood if metrics is not None else None)
+        return self.beliefs[key]
+
+    def put(self, key, probabilities, log_likelihood=None):
+        if key in self.beliefs:
+            self.memory -= self.beliefs.pop(key).nbytes
+        # cached beliefs are shared with callers
+        probabilities.flags.writeable = False
+        self.beliefs[key] = probabilities
+        self.memory += probabilities.nbytes
+        self.log_likelihoods.pop(key, None)
+        if log_likelihood is not None:
+            self.log_likelihoods[key] = log_likelihood
+
+        while self.memory > self.memory_budget and len(self.beliefs) > 1:
+            evicted, evicted_probabilities = self.beliefs.popitem(last=False)
+            self.memory -= evicted_probabilities.nbytes
+            self.log_likelihoods.pop(evicted, None)
+        return probabilities
+
+    def clear(self):
+        self.beliefs.clear()
+        self.log_likelihoods.clear()
+        self.memory = 0
+
+
+class FilterMetrics:
+    """Per-step phase timings, normalizers, log-likelihood and entropy of a filter run, passed as metrics= to the
+    filters; each step is also passed to callback as a dict."""
+
+    def __init__(self, callback=None, underflow_threshold=1e-200):
+        self.callback = callback
+        self.underflow_threshold = underflow_threshold
+        self.steps = 0
+        self.timings = collections.defaultdict(list)
+        self.normalizers = []
+        self.log_likelihoods = []
+        self.entropies = []
+        # steps whose normalizer falls below underflow_threshold
+        self.underflow_steps = []
+        # sum of the log normalizers since the last start(); steps counts every filter step run
+        self.log_likelihood = 0.0
+
+    def time(self, phase, seconds):
+        self.timings[phase].append(seconds)
+
+    def start(self, log_likelihood=0.0):
+        # filtering resumed from a stored belief continues from its log-likelihood (NaN if unknown)
+        self.log_likelihood = log_likelihood
+
+    def step(self, timings, normalizer, probabilities):
+        self.steps += 1
+        for phase, seconds in timings.items():
+            self.time(phase, seconds)
+
+        normalizer = numpy.asarray(normalizer)
+        log_likelihood = numpy.log(normalizer) + self.log_likelihood
+        self.log_likelihood = log_likelihood
+        logs = numpy.log(probabilities, out=numpy.zeros_like(probabilities), where=probabilities > 0)
+        entropy = -(probabilities * logs).sum(axis=(-2, -1))
+        self.normalizers.append(normalizer)
+        self.log_likelihoods.append(log_likelihood)
+        self.entropies.append(entropy)
+        if numpy.any(normalizer < self.underflow_threshold):
+            self.underflow_steps.append(self.steps)
+
+        if self.callback is not None:
+            self.callback({'step': self.steps, **timings, 'normalizer': normalizer.tolist(),
+                           'log_likelihood': log_likelihood.tolist(), 'entropy': entropy.tolist()})
+
+    def summary(self):
+        return {
+            'steps': self.steps,
+            'phases': {phase: {'total': sum(seconds), 'mean': sum(seconds) / len(seconds), 'max': max(seconds)}
+                       for phase, seconds in self.timings.items()},
+            'min_normalizer': float(min(numpy.min(n) for n in self.normalizers)) if self.normalizers else None,
+            'log_likelihood': numpy.asarray(self.log_likelihood).tolist() if self.log_likelihoods else None,
+            'entropy': self.entropies[-1].tolist() if self.entropies else None,
+            'underflow_steps': self.underflow_steps,
+        }
+
+
+class GridFilter:
+    """Online filter that keeps one belief and updates it in place for each (action, sensor reading) pair."""
+
+    def __init__(self, grid, probabilities=None, metrics=None, robot_model=None):
+        self.grid = TerrainGrid.from_rows(grid)
+        self.model = Grid.filter_model(self.grid, robot_model)
+        self.filter_step = Grid.filter_step
+        if metrics is not None:
+            self.filter_step = functools.partial(Grid.profiled_filter_step, metrics=metrics)
+        rows, columns = self.model['shape']
+        if probabilities is None:
+            self.probabilities = Grid.initial_probabilities(self.model)
+        else:
+            self.probabilities = numpy.array(probabilities, dtype=float)
+        self.padded = numpy.zeros((rows + 2, columns + 2))
+        self.step = 0
+
+    def update(self, action, sensor_reading):
+        self.filter_step(self.model, self.probabilities, self.padded, action, sensor_reading)
+        self.step += 1
+        return self.probabilities
+
+    def summary(self, k=5):
+        columns = self.model['shape'][1]
+        probabilities = self.probabilities.ravel()
+
+        k = min(k, probabilities.size)
+        top = numpy.argpartition(probabilities, -k)[-k:]
+        top = top[numpy.argsort(-probabilities[top], kind='stable')]
+        nonzero = probabilities[probabilities > 0]
+
+        return {
+            'step': self.step,
+            'map': divmod(int(top[0]), columns),
+            'map_probability': float(probabilities[top[0]]),
+            'entropy': float(-numpy.sum(nonzero * numpy.log(nonzero))),
+            'top_k': [(divmod(int(cell), columns), float(probabilities[cell])) for cell in top],
+        }
+
+    async def stream(self, updates, k=5):
+        """Update from an async iterable and yield a summary after every update.
+
+        Items are (action, sensor reading) pairs or lines such as b'U N\\n', e.g. from an asyncio.StreamReader.
+        """
+        async for update in updates:
+            if isinstance(update, bytes):
+                update = update.decode('ascii')
+            if isinstance(update, str):
+                update = update.split()
+                if not update:
+                    continue
+            action, sensor_reading = update
+            self.update(action, sensor_reading)
+            yield self.summary(k)
+
+
+class ParticleFilter:
+    """Approximate filter that tracks weighted particles instead of a belief over every cell.
+
+    Particles move and are weighted with the same motion and sensor model as Grid.generate_experiment and are
+    resampled systematically when the effective sample size drops below resample_threshold * num_particles. If it
+    drops below collapse_threshold * num_particles the filter switches to an exact SupportGridFilter that starts from
+    the particle belief (the weights of the cells holding particles), so the switch costs O(num_particles) and no
+    history has to be kept.
+    """
+
+    def __init__(self, grid, num_particles=10000, resample_threshold=0.5, collapse_threshold=0.01, seed=None,
+                 robot_model=None):
+        self.grid = TerrainGrid.from_rows(grid)
+        self.robot_model = robot_model or RobotModel.DEFAULT
+        self.num_particles = num_particles
+        self.resample_threshold = resample_threshold
+        self.collapse_threshold = collapse_threshold
+        self.random = numpy.random.default_rng(seed)
+        self.exact = None
+        self.step = 0
+
+        self.rows, self.columns = Grid.sample_unblocked_cells(self.grid, num_particles, self.random)
+        self.weights = numpy.full(num_particles, 1 / num_particles)
+
+    def update(self, action, sensor_reading):
+        self.step += 1
+        if self.exact is not None:
+            self.exact.update(action, sensor_reading)
+            return
+
+        # actions: each particle moves with the model's probability unless the next cell is blocked or off the grid
+        row_offset, column_offset = self.robot_model.moves[action]
+        rows, columns = self.rows + row_offset, self.columns + column_offset
+        inside = (rows >= 0) & (rows < self.grid.rows) & (columns >= 0) & (columns < self.grid.columns)
+        moves = inside & (self.random.random(self.num_particles) < self.robot_model.move_probability)
+        moves[moves] = ~self.grid.blocked[rows[moves], columns[moves]]
+        self.rows[moves], self.columns[moves] = rows[moves], columns[moves]
+
+        # sensor readings; any other reading is equally likely on every cell
+        if sensor_reading in RobotModel.READINGS:
+            reading = RobotModel.READINGS.index(sensor_reading)
+            self.weights *= self.robot_model.sensor_matrix[self.grid.codes[self.rows, self.columns], reading]
+            self.weights /= self.weights.sum()
+
+        effective_sample_size = 1 / numpy.sum(self.weights ** 2)
+        if effective_sample_size < self.collapse_threshold * self.num_particles:
+            cells, probabilities = self.histogram()
+            self.exact = SupportGridFilter(self.grid, robot_model=self.robot_model, cells=cells,
+                                           probabilities=probabilities)
+            self.exact.step = self.step
+        elif effective_sample_size < self.resample_threshold * self.num_particles:
+            self.resample()
+
+    def resample(self):
+        positions = (self.random.random() + numpy.arange(self.num_particles)) / self.num_particles
+        indices = numpy.minimum(numpy.searchsorted(numpy.cumsum(self.weights), positions), self.num_particles - 1)
+        self.rows, self.columns = self.rows[indices], self.columns[indices]
+        self.weights = numpy.full(self.num_particles, 1 / self.num_particles)
+
+    def histogram(self):
+        """Flat indices of the cells holding particles and their probabilities, particles on the same cell collapsed
+        into one weighted cell."""
+        cells, inverse = numpy.unique(self.rows * self.grid.columns + self.columns, return_inverse=True)
+        return cells, numpy.bincount(inverse, weights=self.weights, minlength=len(cells))
+
+    def summary(self, k=5):
+        if self.exact is not None:
+            return self.exact.summary(k)
+
+        cells, probabilities = self.histogram()
+
+        top = numpy.argsort(-probabilities, kind='stable')[:k]
+        return {
+            'step': self.step,
+            'map': divmod(int(cells[top[0]]), self.grid.columns),
+            'map_probability': float(probabilities[top[0]]),
+            'entropy': float(-numpy.sum(probabilities * numpy.log(probabilities))),
+            'top_k': [(divmod(int(cells[i]), self.grid.columns), float(probabilities[i])) for i in top],
+        }
+
+
+class SupportGridFilter:
+    """Exact online filter that stores and updates only the cells holding probability mass.
+
+    The belief is kept as sorted flat cell indices with their probabilities, so an update costs O(support) instead of
+    O(rows * columns); the support grows by at most one neighbour per cell per motion step. After each update, cells
+    below threshold are pruned (the most likely cell is always kept) and the belief is renormalized; the mass removed
+    so far is kept in discarded_mass. With a threshold of 0 the beliefs are the same as GridFilter's.
+
+    The belief starts uniform over the unblocked cells, or with probabilities on the flat cell indices cells. Sparse
+    updates look up the motion and sensor model of the support cells only; the dense filter kernel is built the first
+    time the support covers a large part of the grid.
+    """
+
+    def __init__(self, grid, threshold=1e-12, robot_model=None, cells=None, probabilities=None):
+        self.grid = TerrainGrid.from_rows(grid)
+        self.robot_model = robot_model or RobotModel.DEFAULT
+        self.model = None
+        self.threshold = threshold
+        self.discarded_mass = 0.0
+        self.step = 0
+        if cells is None:
+            self.cells = numpy.flatnonzero(~self.grid.blocked)
+            if len(self.cells) == 0:
+                raise Exception("No unblocked cells exist")
+            self.probabilities = numpy.full(len(self.cells), 1 / len(self.cells))
+        else:
+            order = numpy.argsort(cells, kind='stable')
+            self.cells = numpy.asarray(cells, dtype=numpy.intp)[order]
+            self.probabilities = numpy.array(probabilities, dtype=float)[order]
+
+    def update(self, action, sensor_reading):
+        rows, columns = self.grid.rows, self.grid.columns
+
+        if len(self.cells) > rows * columns // 16:
+            # while the support covers a large part of the grid the dense update is cheaper
+            if self.model is None:
+                self.model = Grid.filter_model(self.grid, self.robot_model)
+            probabilities = self.dense()
+            Grid.filter_step(self.model, probabilities, numpy.zeros((rows + 2, columns + 2)), action, sensor_reading)
+            cells = numpy.flatnonzero(probabilities)
+            probabilities = probabilities.ravel()[cells]
+        else:
+            cells, probabilities = self.sparse_step(action, sensor_reading)
+
+        # pruning
+        kept = probabilities >= min(self.threshold, probabilities.max())
+        discarded = probabilities[~kept].sum()
+        kept &= probabilities > 0
+        cells, probabilities = cells[kept], probabilities[kept]
+        if discarded > 0:
+            self.discarded_mass += discarded
+            probabilities /= numpy.cumsum(numpy.bincount(cells // columns, weights=probabilities))[-1]
+
+        self.cells, self.probabilities = cells, probabilities
+        self.step += 1
+        return self.probabilities
+
+    def sparse_step(self, action, sensor_reading):
+        rows, columns = self.grid.rows, self.grid.columns
+        row_offset, column_offset = self.robot_model.moves[action]
+        move_probability = self.robot_model.move_probability
+
+        # actions: a cell keeps its stay term and its moving mass arrives at its destination, as in
+        # Grid.transition_coefficients (cells holding mass are never blocked)
+        source_rows, source_columns = numpy.divmod(self.cells, columns)
+        destination_rows, destination_columns = source_rows + row_offset, source_columns + column_offset
+        moves = (destination_rows >= 0) & (destination_rows < rows) \
+            & (destination_columns >= 0) & (destination_columns < columns)
+        moves[moves] = ~self.grid.blocked[destination_rows[moves], destination_columns[moves]]
+        if not (row_offset or column_offset):
+            moves[:] = False
+        sources = numpy.flatnonzero(moves)
+        destinations = self.cells[sources] + (row_offset * columns + column_offset)
+        stay = numpy.where(moves, 1 - move_probability, 1.0)
+
+        # both halves are sorted, so the stable sort is a merge that keeps a cell's stay term before the mass
+        # arriving at it, and bincount adds them in that order like the dense filter
+        cells = numpy.concatenate([self.cells, destinations])
+        order = numpy.argsort(cells, kind='stable')
+        cells = cells[order]
+        first = numpy.concatenate([[True], cells[1:] != cells[:-1]])
+        terms = numpy.concatenate([stay * self.probabilities,
+                                   move_probability * self.probabilities[sources]])
+        probabilities = numpy.bincount(numpy.cumsum(first) - 1, weights=terms[order])
+        cells = cells[first]
+
+        # sensor readings; any other reading is equally likely on every cell
+        if sensor_reading in RobotModel.READINGS:
+            probabilities *= self.robot_model.terrain_likelihoods[self.grid.codes.ravel()[cells],
+                                                                  RobotModel.READINGS.index(sensor_reading)]
+        else:
+            probabilities *= 0.05
+
+        # normalization, summing row by row in the same order as Grid.normalize
+        probabilities /= numpy.cumsum(numpy.bincount(cells // columns, weights=probabilities))[-1]
+        return cells, probabilities
+
+    def dense(self):
+        probabilities = numpy.zeros((self.grid.rows, self.grid.columns))
+        probabilities.ravel()[self.cells] = self.probabilities
+        return probabilities
+
+    def summary(self, k=5):
+        columns = self.grid.columns
+        top = numpy.argsort(-self.probabilities, kind='stable')[:k]
+        return {
+            'step': self.step,
+            'map': divmod(int(self.cells[top[0]]), columns),
+            'map_probability': float(self.probabilities[top[0]]),
+            'entropy': float(-numpy.sum(self.probabilities * numpy.log(self.probabilities))),
+            'top_k': [(divmod(int(self.cells[i]), columns), float(self.probabilities[i])) for i in top],
+        }
+
+
+class PyramidGridFilter:
+    """Fine-to-coarse online filter for large grids that stops tracking the cells the evidence has ruled out.
+
+    The grid is split into block_size x block_size blocks. The filter starts with every block refined, filtering its
+    cells exactly like GridFilter, and a refined block whose mass drops below a tenth of refine_threshold times the
+    heaviest block's is coarsened unless it neighbours a block holding at least refine_threshold times it. A coarse
+    block keeps only its total mass, taken to be spread evenly over its unblocked cells; its motion uses the number
+    of cells that can move into each neighbouring block and its sensor update the mean likelihood of its cells. A
+    coarse block is refined again once it or a neighbour reaches refine_threshold times the heaviest block's mass,
+    while fewer than max_refined_blocks blocks are refined. With a refine_threshold of 0 no block is coarsened and
+    the beliefs are GridFilter's (up to rounding).
+
+    Blocks are only coarsened on the evidence of exact updates, because the mean likelihood of a coarse block is
+    biased low against the exact likelihoods of refined cells; a block refined late from a coarse mass would lose to
+    blocks that were tracked all along. Memory and time therefore start at those of a dense filter, updated
+    CHUNK_BLOCKS blocks at a time, and shrink as the belief concentrates.
+    """
+    CHUNK_BLOCKS = 4096
+
+    def __init__(self, grid, block_size=16, refine_threshold=1e-4, max_refined_blocks=4096, robot_model=None):
+        self.grid = TerrainGrid.from_rows(grid)
+        self.robot_model = robot_model or RobotModel.DEFAULT
+        self.block_size = block_size
+        self.refine_threshold = refine_threshold
+        self.max_refined_blocks = max_refined_blocks
+        self.step = 0
+        self.log_likelihood = 0.0
+
+        # terrain codes padded with blocked cells to whole blocks and a one-cell border
+        self.block_rows, self.block_columns = -(-self.grid.rows // block_size), -(-self.grid.columns // block_size)
+        self.codes = numpy.full((self.block_rows * block_size + 2, self.block_columns * block_size + 2),
+                                TerrainGrid.CODES[Grid.BLOCKED], dtype=numpy.uint8)
+        self.codes[1:self.grid.rows + 1, 1:self.grid.columns + 1] = self.grid.codes
+        unblocked = self.codes != TerrainGrid.CODES[Grid.BLOCKED]
+
+        def blocks(cells):
+            return cells.reshape(self.block_rows, block_size, self.block_columns, block_size)
+
+        # coarse model: unblocked cells, mean likelihood of every reading and, for every action, the number of cells
+        # moving into each neighbouring block (offsets in -1, 0, 1)
+        codes = blocks(self.codes[1:-1, 1:-1])
+        terrain_counts = numpy.stack([(codes == code).sum(axis=(1, 3)) for code in range(len(TerrainGrid.TERRAINS))])
+        self.cell_counts = blocks(unblocked[1:-1, 1:-1]).sum(axis=(1, 3))
+        if not self.cell_counts.any():
+            raise Exception("No unblocked cells exist")
+        with numpy.errstate(invalid='ignore'):
+            self.block_likelihoods = numpy.nan_to_num(numpy.einsum('tij,tr->rij', terrain_counts,
+                                                                   self.robot_model.terrain_likelihoods)
+                                                      / self.cell_counts)
+
+        rows, columns = unblocked.shape[0] - 2, unblocked.shape[1] - 2
+        self.block_moves = {}
+        for action, (row_offset, column_offset) in self.robot_model.moves.items():
+            moving = blocks(unblocked[1:-1, 1:-1] & unblocked[1 + row_offset:1 + row_offset + rows,
+                                                              1 + column_offset:1 + column_offset + columns])
+            self.block_moves[action] = []
+            for row_step, row_cells in PyramidGridFilter.edges(row_offset, block_size):
+                for column_step, column_cells in PyramidGridFilter.edges(column_offset, block_size):
+                    if row_step or column_step:
+                        counts = moving[:, row_cells][:, :, :, column_cells].sum(axis=(1, 3))
+                        self.block_moves[action].append((row_step, column_step, row_cells, column_cells, counts))
+
+        # coarse masses (0 for refined blocks) and the refined blocks' cells, stacked in refined_blocks order; every
+        # block holding cells starts refined with a uniform belief
+        self.coarse = self.cell_counts / self.cell_counts.sum()
+        self.refined_blocks = numpy.empty((0, 2), dtype=numpy.intp)
+        self.refined_index = numpy.full((self.block_rows, self.block_columns), -1, dtype=numpy.intp)
+        self.windows = numpy.empty((0, block_size + 2, block_size + 2), dtype=numpy.uint8)
+        self.cells = numpy.empty((0, block_size, block_size))
+        self.rebuild(numpy.empty(0, dtype=bool), numpy.argwhere(self.cell_counts > 0))
+
+    @classmethod
+    def edges(cls, offset, block_size):
+        """(block step, cells) pairs splitting one axis of a block by the block a move of offset ends in."""
+        if offset < 0:
+            return [(-1, slice(0, 1)), (0, slice(1, block_size))]
+        if offset > 0:
+            return [(0, slice(0, block_size - 1)), (1, slice(block_size - 1, block_size))]
+        return [(0, slice(0, block_size))]
+
+    def window(self, blocks):
+        """Terrain codes of the given blocks with a one-cell border, as a K x (block_size + 2) x (block_size + 2)
+        stack."""
+        cells = numpy.arange(self.block_size + 2)
+        return self.codes[(blocks[:, 0] * self.block_size)[:, None, None] + cells[None, :, None],
+                          (blocks[:, 1] * self.block_size)[:, None, None] + cells[None, None, :]]
+
+    def refine(self):
+        # coarsen refined blocks the evidence ruled out, then refine coarse blocks that regained mass within the
+        # budget, both relative to the heaviest block; the neighbours of a block holding at least refine_threshold of
+        # it stay refined too, so mass moving out of it never crosses into a coarse block and loses its position
+        masses = self.cells.sum(axis=(1, 2))
+        block_masses = self.coarse.copy()
+        block_masses[self.refined_blocks[:, 0], self.refined_blocks[:, 1]] = masses
+        heavy = numpy.pad(block_masses >= self.refine_threshold * block_masses.max(), 1)
+        near = numpy.zeros_like(block_masses, dtype=bool)
+        for row_step in [-1, 0, 1]:
+            for column_step in [-1, 0, 1]:
+                near |= heavy[1 + row_step:1 + row_step + self.block_rows,
+                              1 + column_step:1 + column_step + self.block_columns]
+
+        keep = (masses >= self.refine_threshold / 10 * block_masses.max()) \
+            | near[self.refined_blocks[:, 0], self.refined_blocks[:, 1]]
+        new_blocks = numpy.argwhere(near & (self.cell_counts > 0) & (self.refined_index < 0))
+        room = max(self.max_refined_blocks - numpy.count_nonzero(keep), 0)
+        if len(new_blocks) > room:
+            new_masses = self.coarse[new_blocks[:, 0], new_blocks[:, 1]]
+            new_blocks = new_blocks[numpy.sort(numpy.argsort(-new_masses, kind='stable')[:room])]
+        if keep.all() and len(new_blocks) == 0:
+            return
+        self.rebuild(keep, new_blocks)
+
+    def rebuild(self, keep, new_blocks):
+        """Coarsen the refined blocks not in keep and refine new_blocks, spreading their mass evenly over their
+        unblocked cells."""
+        coarsened = self.refined_blocks[~keep]
+        self.coarse[coarsened[:, 0], coarsened[:, 1]] = self.cells[~keep].sum(axis=(1, 2))
+
+        windows = self.window(new_blocks)
+        unblocked = windows[:, 1:-1, 1:-1] != TerrainGrid.CODES[Grid.BLOCKED]
+        counts = self.cell_counts[new_blocks[:, 0], new_blocks[:, 1]]
+        cells = unblocked * (self.coarse[new_blocks[:, 0], new_blocks[:, 1]] / counts)[:, None, None]
+        self.coarse[new_blocks[:, 0], new_blocks[:, 1]] = 0
+
+        self.refined_blocks = numpy.concatenate([self.refined_blocks[keep], new_blocks])
+        self.windows = numpy.concatenate([self.windows[keep], windows])
+        self.cells = numpy.concatenate([self.cells[keep], cells])
+        self.refined_index[:] = -1
+        self.refined_index[tuple(self.refined_blocks.T)] = numpy.arange(len(self.refined_blocks))
+
+    def update(self, action, sensor_reading):
+        move_probability = self.robot_model.move_probability
+        with numpy.errstate(invalid='ignore'):
+            density = numpy.nan_to_num(self.coarse / self.cell_counts)
+
+        # coarse motion: the cells of a coarse block that move into each neighbouring block
+        coarse = self.coarse.copy()
+        for row_step, column_step, _, _, counts in self.block_moves[action]:
+            flow = density * move_probability * counts
+            coarse -= flow
+            coarse[max(row_step, 0):self.block_rows + min(row_step, 0),
+                   max(column_step, 0):self.block_columns + min(column_step, 0)] += \
+                flow[max(-row_step, 0):self.block_rows + min(-row_step, 0),
+                     max(-column_step, 0):self.block_columns + min(-column_step, 0)]
+        # mass moving into refined blocks arrives through their borders
+        coarse[self.refined_blocks[:, 0], self.refined_blocks[:, 1]] = 0
+
+        # refined cells, a chunk of blocks at a time so the temporaries stay small; the borders are read from the
+        # cells before the update
+        cells = numpy.empty_like(self.cells)
+        for start in range(0, len(self.cells), PyramidGridFilter.CHUNK_BLOCKS):
+            chunk = slice(start, start + PyramidGridFilter.CHUNK_BLOCKS)
+            cells[chunk] = self.predict(chunk, action, density, coarse)
+        self.cells = cells
+
+        # sensor readings; any other reading is equally likely on every cell
+        if sensor_reading in RobotModel.READINGS:
+            reading = RobotModel.READINGS.index(sensor_reading)
+            for start in range(0, len(self.cells), PyramidGridFilter.CHUNK_BLOCKS):
+                chunk = slice(start, start + PyramidGridFilter.CHUNK_BLOCKS)
+                self.cells[chunk] *= self.robot_model.terrain_likelihoods[self.windows[chunk, 1:-1, 1:-1], reading]
+            coarse *= self.block_likelihoods[reading]
+
+        normalizer = coarse.sum() + self.cells.sum()
+        self.coarse = coarse / normalizer
+        self.cells /= normalizer
+        self.log_likelihood += math.log(normalizer)
+        self.step += 1
+
+        self.refine()
+        return self
+
+    def predict(self, chunk, action, density, coarse):
+        """Cells of the refined blocks in chunk after action, adding the mass they move into coarse blocks to coarse."""
+        block_size = self.block_size
+        row_offset, column_offset = self.robot_model.moves[action]
+        move_probability = self.robot_model.move_probability
+        refined_blocks, windows, cells = self.refined_blocks[chunk], self.windows[chunk], self.cells[chunk]
+
+        # cells with a border of their neighbours' cells: refined cells or the density of a coarse block
+        unblocked = windows != TerrainGrid.CODES[Grid.BLOCKED]
+        padded = numpy.zeros(windows.shape)
+        padded[:, 1:-1, 1:-1] = cells
+        border = {-1: (0, block_size - 1), 0: (slice(1, -1), slice(None)), 1: (-1, 0)}
+        for row_step in [-1, 0, 1]:
+            for column_step in [-1, 0, 1]:
+                if not (row_step or column_step):
+                    continue
+                neighbours = refined_blocks + (row_step, column_step)
+                inside = numpy.flatnonzero((neighbours[:, 0] >= 0) & (neighbours[:, 0] < self.block_rows)
+                                           & (neighbours[:, 1] >= 0) & (neighbours[:, 1] < self.block_columns))
+                neighbours = neighbours[inside]
+                (padded_rows, rows), (padded_columns, columns) = border[row_step], border[column_step]
+                index = self.refined_index[neighbours[:, 0], neighbours[:, 1]]
+                refined = index >= 0
+                padded[inside[refined], padded_rows, padded_columns] = self.cells[index[refined]][:, rows, columns]
+                coarse_neighbours = inside[~refined]
+                neighbour_density = density[neighbours[~refined, 0], neighbours[~refined, 1]]
+                open_cells = unblocked[coarse_neighbours, padded_rows, padded_columns]
+                padded[coarse_neighbours, padded_rows, padded_columns] = \
+                    open_cells * neighbour_density.reshape((-1,) + (1,) * (open_cells.ndim - 1))
+
+        # refined cells moving into coarse blocks
+        moving = move_probability * cells * (unblocked[:, 1:-1, 1:-1] & unblocked[
+            :, 1 + row_offset:1 + row_offset + block_size, 1 + column_offset:1 + column_offset + block_size])
+        for row_step, column_step, rows, columns, _ in self.block_moves[action]:
+            neighbours = refined_blocks + (row_step, column_step)
+            inside = (neighbours[:, 0] >= 0) & (neighbours[:, 0] < self.block_rows) \
+                & (neighbours[:, 1] >= 0) & (neighbours[:, 1] < self.block_columns)
+            inside[inside] = self.refined_index[neighbours[inside, 0], neighbours[inside, 1]] < 0
+            numpy.add.at(coarse, (neighbours[inside, 0], neighbours[inside, 1]),
+                         moving[inside][:, rows, columns].sum(axis=(1, 2)))
+
+        # refined motion, as in Grid.predict
+        stay, arrive, (source_row, source_column) = Grid.transition_coefficients(unblocked, row_offset, column_offset,
+                                                                                 move_probability)
+        return stay * cells + arrive * padded[:, 1 + source_row:1 + source_row + block_size,
+                                              1 + source_column:1 + source_column + block_size]
+
+    def dense(self):
+        """The belief over every cell, coarse blocks spread evenly over their unblocked cells."""
+        block_size = self.block_size
+        with numpy.errstate(invalid='ignore'):
+            density = numpy.nan_to_num(self.coarse / self.cell_counts)
+        probabilities = numpy.repeat(numpy.repeat(density, block_size, axis=0), block_size, axis=1)
+        probabilities *= self.codes[1:-1, 1:-1] != TerrainGrid.CODES[Grid.BLOCKED]
+        blocks = probabilities.reshape(self.block_rows, block_size, self.block_columns, block_size).swapaxes(1, 2)
+        blocks[self.refined_blocks[:, 0], self.refined_blocks[:, 1]] = self.cells
+        return probabilities[:self.grid.rows, :self.grid.columns]
+
+    def summary(self, k=5):
+        """Like GridFilter.summary, over the refined cells only, with the number of refined blocks and their mass."""
+        probabilities = self.cells.ravel()
+        k = min(k, probabilities.size)
+        top = numpy.argpartition(probabilities, -k)[-k:] if k else numpy.empty(0, dtype=numpy.intp)
+        top = top[numpy.argsort(-probabilities[top], kind='stable')]
+
+        def location(cell):
+            block, row, column = numpy.unravel_index(cell, self.cells.shape)
+            block_row, block_column = self.refined_blocks[block]
+            return int(block_row * self.block_size + row), int(block_column * self.block_size + column)
+
+        return {
+            'step': self.step,
+            'map': location(top[0]) if k else None,
+            'map_probability': float(probabilities[top[0]]) if k else None,
+            'refined_blocks': len(self.refined_blocks),
+            'refined_mass': float(probabilities.sum()),
+            'log_likelihood': self.log_likelihood,
+            'top_k': [(location(cell), float(probabilities[cell])) for cell in top],
+        }
+
 
 def test():
     grid = None
@@ -443,6 +1612,69 @@ def test():
             except Exception as e:
                 print("[Failed] Calculate probabilities:\n" + e.__str__() + '\n\n')
 
+            try:
+                path, log_probability = Grid.viterbi(grid, actions, sensor_readings)
+                if len(path) != len(actions) + 1 or any(grid[r][c] == Grid.BLOCKED for r, c in path):
+                    raise Exception('Invalid path')
+                print("[PASSED] Viterbi\n\n")
+            except Exception as e:
+                print("[FAILED] Viterbi:\n" + e.__str__() + '\n\n')
+
+            try:
+                stay_model = RobotModel(moves={**Grid.MOVES, 'S': (0, 0)})
+                path, log_probability = Grid.viterbi([[Grid.NORMAL] * 2] * 2, ['S', 'S'], ['N', 'N'], stay_model)
+                if len(set(path)) != 1 or not math.isclose(log_probability, math.log(0.25 * 0.9 * 0.9)):
+                    raise Exception('Invalid path')
+                print("[PASSED] Viterbi with a stay action\n\n")
+            except Exception as e:
+                print("[FAILED] Viterbi with a stay action:\n" + e.__str__() + '\n\n')
+
+            try:
+                probabilities, log_likelihood = Grid.calculate_log_likelihood(grid, actions, sensor_readings, 0,
+                                                                              len(actions))
+                if not numpy.array_equal(probabilities, Grid.calculate_next_probabilities(
+                        grid, actions, sensor_readings, 0, len(actions))) or not log_likelihood <= 0:
+                    raise Exception('Log-likelihood mismatch')
+                print("[PASSED] Log-likelihood\n\n")
+            except Exception as e:
+                print("[FAILED] Log-likelihood:\n" + e.__str__() + '\n\n')
+
+            try:
+                steps = range(len(actions) + 1)
+                smoothed, _ = Grid.smooth_probabilities(grid, actions, sensor_readings, steps, checkpoint_interval=1)
+                checkpointed, _ = Grid.smooth_probabilities(grid, actions, sensor_readings, steps, checkpoint_interval=7)
+                if any(not numpy.allclose(smoothed[step], checkpointed[step], rtol=1e-12, atol=0) for step in steps):
+                    raise Exception('Smoothed belief mismatch')
+                print("[PASSED] Checkpointed smoothing\n\n")
+            except Exception as e:
+                print("[FAILED] Checkpointed smoothing:\n" + e.__str__() + '\n\n')
+
+            try:
+                grid_filter, support_filter = GridFilter(grid), SupportGridFilter(grid, 0)
+                pruned_filter = SupportGridFilter(grid, 0.01)
+                for action, sensor_reading in zip(actions, sensor_readings):
+                    grid_filter.update(action, sensor_reading)
+                    support_filter.update(action, sensor_reading)
+                    pruned_filter.update(action, sensor_reading)
+                    if not numpy.array_equal(grid_filter.probabilities, support_filter.dense()):
+                        raise Exception('Belief mismatch')
+                if not pruned_filter.discarded_mass > 0:
+                    raise Exception('No mass pruned')
+                print("[PASSED] Support filter\n\n")
+            except Exception as e:
+                print("[FAILED] Support filter:\n" + e.__str__() + '\n\n')
+
+            try:
+                pyramid_filter = PyramidGridFilter(grid, 8, 0, len(grid) * len(grid[0]))
+                for action, sensor_reading in zip(actions, sensor_readings):
+                    pyramid_filter.update(action, sensor_reading)
+                if not numpy.allclose(pyramid_filter.dense(), Grid.calculate_next_probabilities(
+                        grid, actions, sensor_readings, 0, len(actions)), rtol=1e-9, atol=1e-15):
+                    raise Exception('Belief mismatch')
+                print("[PASSED] Pyramid filter\n\n")
+            except Exception as e:
+                print("[FAILED] Pyramid filter:\n" + e.__str__() + '\n\n')
+
     try:
         Grid.generate_experiment([[Grid.BLOCKED] * 100] * 50)
         print("[FAILED] Generate experiment of blocked grid\n\n")
@@ -450,6 +1682,27 @@ def test():
         if e.__str__() == "No unblocked cells exist":
             print("[PASSED] Generate experiments of blocked grid\n\n")
 
+    try:
+        PyramidGridFilter([[Grid.BLOCKED] * 100] * 50)
+        print("[FAILED] Pyramid filter of blocked grid\n\n")
+    except Exception as e:
+        if e.__str__() == "No unblocked cells exist":
+            print("[PASSED] Pyramid filter of blocked grid\n\n")
+
+    try:
+        large_grid = Grid.generate_grid(100, 100)
+        _, large_actions, large_sensor_readings = Grid.generate_experiment(large_grid)
+        grid_filter, pyramid_filter = GridFilter(large_grid), PyramidGridFilter(large_grid)
+        for action, sensor_reading in zip(large_actions, large_sensor_readings):
+            grid_filter.update(action, sensor_reading)
+            pyramid_filter.update(action, sensor_reading)
+        if pyramid_filter.summary()['map'] != grid_filter.summary()['map'] \
+                or numpy.abs(pyramid_filter.dense() - grid_filter.probabilities).sum() > 1e-3:
+            raise Exception('Belief mismatch')
+        print("[PASSED] Pyramid filter on a multi-block grid\n\n")
+    except Exception as e:
+        print("[FAILED] Pyramid filter on a multi-block grid:\n" + e.__str__() + '\n\n')
+
     if grid_filepath is not None:
         try:
             imported_grid = Grid.import_grid(grid_filepath)
@@ -460,6 +1713,18 @@ def test():
         except Exception as e:
             print('[FAILED] Import grid:\n' + e.__str__() + '\n\n')
 
+    if grid is not None:
+        try:
+            binary_grid_filepath = Grid.save_grid(grid, '../test/grid_test.npy')
+            try:
+                if not Grid.import_grid(binary_grid_filepath) == grid:
+                    raise Exception('Grid mismatch')
+            finally:
+                os.remove(binary_grid_filepath)
+            print('[PASSED] Save and import binary grid\n\n')
+        except Exception as e:
+            print('[FAILED] Save and import binary grid:\n' + e.__str__() + '\n\n')
+
     if experiment_filepath is not None:
         try:
             imported_ground_truth_states, imported_actions, imported_sensor_readings \
@@ -473,6 +1738,24 @@ def test():
         except Exception as e:
             print('[FAILED] Import experiment:\n' + e.__str__() + '\n\n')
 
+    try:
+        experiment_filepaths = [f'../out/grid_0_experiment_{y}.txt' for y in range(10)]
+        experiments = Grid.encode_experiments([Grid.import_experiment(f, 100) for f in experiment_filepaths])
+        container_filepath = Grid.save_experiments(experiments, '../test/grid_experiments_test.npy')
+        try:
+            container_results = evaluate_experiments('../out/grid_0.txt', container_filepath)
+            start_row, start_column = Grid.import_experiment(experiment_filepaths[0], 0)[0][0].split()
+            if not numpy.array_equal(Grid.import_experiments(container_filepath)['ground_truth'][0, 0],
+                                     [int(start_row), int(start_column)]) \
+                    or not all(numpy.array_equal(a, b) for a, b in zip(
+                        container_results, evaluate_experiments('../out/grid_0.txt', experiment_filepaths))):
+                raise Exception('Experiment mismatch')
+        finally:
+            os.remove(container_filepath)
+        print('[PASSED] Convert experiments to a container\n\n')
+    except Exception as e:
+        print('[FAILED] Convert experiments to a container:\n' + e.__str__() + '\n\n')
+
     grid = Grid.import_grid('../out/grid_0.txt')  # Grid.import_grid('part_a_grid.txt')
     ground_truth_states, actions, sensor_readings = Grid.import_experiment('../out/grid_0_experiment_0.txt',
                                                                            100)  # Grid.import_experiment('part_a_experiment.txt', 4)
@@ -481,66 +1764,188 @@ def test():
         Grid.draw_grid(grid, actions, sensor_readings)
 
 
-def generate_10_maps_and_100_experiments():
+def generate_10_maps_and_100_experiments(seed=None):
     if not os.path.exists('../out'):
         os.makedirs('../out')
 
-    for x in range(10):
-        grid = Grid.generate_grid(100, 50)
+    for x, (grid, experiments) in enumerate(Grid.generate_dataset(10, 10, 100, 50, 100, seed)):
         Grid.save_grid(grid, f'../out/grid_{x}.txt')
         for y in range(10):
-            ground_truth_states, actions, sensor_readings = Grid.generate_experiment(grid)
+            ground_truth_states, actions, sensor_readings = Grid.decode_experiment(experiments, y)
             Grid.save_experiment(ground_truth_states, actions, sensor_readings, f'../out/grid_{x}_experiment_{y}.txt')
 
 
-def generate_error_rate_of_100_experiments():
-    def find_maximum(probabilities):
-        r = 0
-        c = 0
-        highest_value = 0
-        for row in range(len(probabilities)):
-            for column in range(len(probabilities[0])):
-                if probabilities[row][column] > highest_value:
-                    highest_value = probabilities[row][column]
-                    r = row
-                    c = column
-        return r, c
-
-    def get_ground_truth_location(ground_truth):
-        row, column = ground_truth.split()
-        return int(row) - 1, int(column) - 1
-
-    def calculate_average_experiment_error_and_probability(grid, filepath, num_actions):
-        ground_truth_states, actions, sensor_readings = Grid.import_experiment(filepath, num_actions)
-        probabilities = Grid.calculate_next_probabilities(grid, actions, sensor_readings, 0, 4)
-        error_distance = []
-        ground_truth_path_probability = []
-        for step in range(4, len(ground_truth_states) - 1):
-            probabilities = Grid.calculate_next_probabilities(grid, actions, sensor_readings, step, step + 1,
-                                                              probabilities)
-            pr, pc = find_maximum(probabilities)
-            gr, gc = get_ground_truth_location(ground_truth_states[step])
-            error_distance.append(math.sqrt((pr - gr) ** 2 + (pc - gc) ** 2))
-            ground_truth_path_probability.append(probabilities[gr][gc])
-        return numpy.mean(error_distance), numpy.mean(ground_truth_path_probability)
+def convert_experiments_to_containers():
+    for x in range(10):
+        experiments = [Grid.import_experiment(f'../out/grid_{x}_experiment_{y}.txt', 100) for y in range(10)]
+        Grid.save_experiments(Grid.encode_experiments(experiments), f'../out/grid_{x}_experiments.npy')
+
+
+def evaluate_experiments(grid_filepath, experiments, num_steps=100, warm_up_steps=4, metrics=None):
+    """Per-step errors of every experiment of one grid.
+
+    experiments is a save_experiments container filepath or a list of text experiment filepaths. The most likely
+    cell after step + 1 actions is compared with ground truth state step, skipping the first warm_up_steps steps
+    while the belief is still spread over the grid.
+
+    Returns the distance errors and the ground truth probabilities as K x (num_steps - warm_up_steps) arrays.
+    """
+    grid = Grid.import_grid(grid_filepath)
+    if isinstance(experiments, str):
+        experiments = Grid.import_experiments(experiments)
+    else:
+        experiments = Grid.encode_experiments([Grid.import_experiment(filepath, num_steps)
+                                               for filepath in experiments])
+
+    actions = numpy.asarray(experiments['actions'][:, :num_steps])
+    num_steps = actions.shape[1]
+    # containers store uint16 locations, which must not wrap around when subtracted
+    ground_truth_locations = numpy.asarray(experiments['ground_truth'][:, :num_steps], dtype=numpy.intp)
+    # the error rates have always compared the belief after action i with the cell before that move, one step
+    # behind the belief; shift the locations by a step so calculate_batch_probabilities reads them the same way
+    shifted_locations = numpy.concatenate([ground_truth_locations[:, :1], ground_truth_locations], axis=1)
+    _, maximum_locations, ground_truth_probabilities = Grid.calculate_batch_probabilities(
+        grid, actions, numpy.asarray(experiments['sensor_readings'][:, :num_steps]), 0, num_steps,
+        ground_truth_locations=shifted_locations, metrics=metrics)
+
+    distance_errors = numpy.sqrt(((maximum_locations - ground_truth_locations)[:, warm_up_steps:] ** 2).sum(axis=2))
+    return distance_errors, ground_truth_probabilities[:, warm_up_steps:]
+
+
+def evaluate_grid_job(job):
+    grid_id, grid_filepath, experiments, num_steps, warm_up_steps, profile = job
+    metrics = FilterMetrics() if profile else None
+    results = evaluate_experiments(grid_filepath, experiments, num_steps, warm_up_steps, metrics)
+    return grid_id, results, metrics.summary() if profile else None
+
+
+def error_rate_rows(grid_id, distance_errors, ground_truth_probabilities, warm_up_steps):
+    rows = []
+    for experiment, (errors, probabilities) in enumerate(zip(distance_errors, ground_truth_probabilities)):
+        for i, (error, probability) in enumerate(zip(errors.tolist(), probabilities.tolist())):
+            rows.append((grid_id, experiment, warm_up_steps + i + 1, error, probability))
+    return rows
+
+
+ERROR_RATE_COLUMNS = ['grid', 'experiment', 'step', 'distance_error', 'ground_truth_probability']
+
+
+def evaluate_error_rates(jobs, output_filepath, num_steps=100, warm_up_steps=4, processes=None, resume=False,
+                         metrics_filepath=None):
+    """Evaluate the grids of jobs ({grid id: (grid filepath, experiments)}) in a process pool, streaming per-step rows
+    to a CSV or .parquet file; returns the grid ids evaluated."""
+    parquet = output_filepath.endswith('.parquet')
+    if parquet:
+        import pyarrow
+        import pyarrow.parquet
+
+    # rows kept from an earlier run, minus the last grid of a CSV file, which may be incomplete; resuming only looks
+    # at grid ids, so it is only for finishing an interrupted run over the same files
+    kept = []
+    if resume and os.path.exists(output_filepath):
+        if parquet:
+            try:
+                kept = [tuple(row[c] for c in ERROR_RATE_COLUMNS)
+                        for row in pyarrow.parquet.read_table(output_filepath).to_pylist()]
+            except pyarrow.ArrowInvalid:
+                # killed before the footer was written, a Parquet file is only readable once closed
+                kept = []
+        else:
+            with open(output_filepath, "r") as file:
+                lines = [line for line in file.readlines()[1:] if line.endswith('\n')]
+            kept = [line for line in lines if line.split(',', 1)[0] != lines[-1].split(',', 1)[0]] if lines else []
+    completed = {str(row[0]) if parquet else row.split(',', 1)[0] for row in kept}
+
+    remaining = [(grid_id, grid_filepath, experiments, num_steps, warm_up_steps, metrics_filepath is not None)
+                 for grid_id, (grid_filepath, experiments) in jobs.items() if str(grid_id) not in completed]
+
+    schema = None
+    if parquet:
+        schema = pyarrow.schema([('grid', pyarrow.string()), ('experiment', pyarrow.int64()),
+                                 ('step', pyarrow.int64()), ('distance_error', pyarrow.float64()),
+                                 ('ground_truth_probability', pyarrow.float64())])
+
+    def table(rows):
+        return pyarrow.Table.from_pylist([dict(zip(ERROR_RATE_COLUMNS, (str(row[0]),) + tuple(row[1:])))
+                                          for row in rows], schema=schema)
+
+    evaluated = []
+    writer = pyarrow.parquet.ParquetWriter(output_filepath, schema) if parquet else open(output_filepath, "w")
+    with writer, multiprocessing.Pool(processes) as pool:
+        if parquet:
+            if kept:
+                writer.write_table(table(kept))
+        else:
+            writer.write(','.join(ERROR_RATE_COLUMNS) + '\n' + ''.join(kept))
+            writer.flush()
+
+        for grid_id, (distance_errors, ground_truth_probabilities), summary in pool.imap_unordered(evaluate_grid_job,
+                                                                                                   remaining):
+            # a grid's rows are written together, so an interruption leaves at most the last grid incomplete
+            rows = error_rate_rows(grid_id, distance_errors, ground_truth_probabilities, warm_up_steps)
+            if parquet:
+                writer.write_table(table(rows))
+            else:
+                writer.write(''.join(f'{g},{e},{s},{d},{p}\n' for g, e, s, d, p in rows))
+                writer.flush()
+            if summary is not None:
+                # one JSON line per profiled grid
+                with open(metrics_filepath, "a") as file:
+                    file.write(json.dumps({'grid': grid_id, **summary}) + '\n')
+            evaluated.append(grid_id)
+            print(f'[INFO] Evaluated grid {grid_id}')
+    return evaluated
+
+
+def rank_grid_files_job(job):
+    grid_filepaths, actions, sensor_readings, margin = job
+    ranking = Grid.rank_grids([Grid.import_grid(filepath) for filepath in grid_filepaths], actions, sensor_readings,
+                              margin)
+    return [(grid_filepaths[index], log_likelihood, dropped) for index, log_likelihood, dropped in ranking]
+
+
+def rank_grid_files(grid_filepaths, actions, sensor_readings, margin=30.0, processes=None, chunk_size=50):
+    """Rank stored grids by the likelihood of one trajectory, splitting them into chunks of chunk_size grids that
+    are ranked with Grid.rank_grids in a process pool; the merged chunks are ordered like one rank_grids call, against
+    the best grid of every chunk.
+
+    Returns (grid filepath, log-likelihood, step the grid was dropped at or None) for every grid, most likely first.
+    """
+    jobs = [(grid_filepaths[i:i + chunk_size], actions, sensor_readings, margin)
+            for i in range(0, len(grid_filepaths), chunk_size)]
+    with multiprocessing.Pool(processes) as pool:
+        rankings = pool.map(rank_grid_files_job, jobs, chunksize=1)
+
+    return Grid.order_ranking([candidate for chunk in rankings for candidate in chunk], margin, len(actions))
+
+
+def generate_error_rate_of_100_experiments(warm_up_steps=4, processes=None):
+    jobs = {x: (f'../out/grid_{x}.txt', [f'../out/grid_{x}_experiment_{y}.txt' for y in range(10)])
+            for x in range(10)}
+    evaluate_error_rates(jobs, '../out/error_rate_steps.csv', 100, warm_up_steps, processes, resume=False)
+
+    # average the per-step rows of every experiment, in grid and experiment order
+    steps = numpy.loadtxt('../out/error_rate_steps.csv', delimiter=',', skiprows=1, ndmin=2)
+    steps = steps[numpy.lexsort((steps[:, 2], steps[:, 1], steps[:, 0]))]
+    experiments, counts = numpy.unique(steps[:, :2], axis=0, return_counts=True)
+    average_distance_errors = steps[:, 3].reshape(len(experiments), counts[0]).mean(axis=1)
+    average_ground_truth_path_probabilities = steps[:, 4].reshape(len(experiments), counts[0]).mean(axis=1)
 
     with open('../out/error_rate.csv', "w") as file:
         file.write("grid,experiment,average_distance_error, average_ground_truth_path_probability\n")
-        for x in range(10):
-            grid = Grid.import_grid(f'../out/grid_{x}.txt')
-            for y in range(10):
-                average_distance_error, average_ground_truth_path_probability = \
-                    calculate_average_experiment_error_and_probability(grid, f'../out/grid_{x}_experiment_{y}.txt', 100)
-                file.write(f'{x},{y},{average_distance_error},{average_ground_truth_path_probability}\n')
-
-
-def get_heatmap():
-    for x in range(10):
-        grid = Grid.import_grid(f'../out/grid_{x}.txt')
-        for y in range(10):
-            filepath = f'../out/grid_{x}_experiment_{y}.txt'
-            ground_truth_states, actions, sensor_readings = Grid.import_experiment(filepath, 100)
-            Grid.draw_grid(grid, actions, sensor_readings, experiment_filepath=filepath)
+        for (x, y), average_distance_error, average_ground_truth_path_probability in zip(
+                experiments, average_distance_errors, average_ground_truth_path_probabilities):
+            file.write(f'{int(x)},{int(y)},{average_distance_error},{average_ground_truth_path_probability}\n')
+
+
+def get_heatmap(labels=False, processes=None):
+    jobs = [(f'../out/grid_{x}.txt', f'../out/grid_{x}_experiment_{y}.txt', (10, 50, 100), labels)
+            for x in range(10) for y in range(10)]
+    import render
+    with multiprocessing.Pool(processes, initializer=render.init_heatmap_worker) as pool:
+        for written in pool.starmap(render.export_heatmaps, jobs, chunksize=1):
+            for output in written:
+                print(f'[INFO] Saved {output}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,269 @@
+"""pygame rendering of grids and beliefs.
+
+Kept apart from grid.py so the inference, generation and I/O code imports without pygame; Grid.draw_grid and
+get_heatmap import this module when they are first used.
+"""
+import os
+import sys
+import time
+
+import numpy
+import pygame
+from pygame.locals import *
+
+from grid import BeliefCache, Grid, TerrainGrid
+
+
+def draw_grid(grid, actions, sensor_readings, experiment_filepath=None, cache=None, metrics=None):
+    width, height = 1000, 1000
+    grid = TerrainGrid.from_rows(grid)
+    if cache is None:
+        cache = BeliefCache()
+
+    pygame.init()
+    renderer = GridRenderer(grid)
+
+    zoom = 1
+    step = 0
+    probabilities = cache.get(grid, actions, sensor_readings, step, metrics=metrics)
+    moving = False
+
+    if experiment_filepath:
+        base = os.path.splitext(experiment_filepath)[0]
+
+        # the whole canvas is saved, so render every cell onto one reused surface
+        canvas = pygame.Surface(renderer.canvas_size(zoom))
+        for step in [10, 50, 100]:
+            probabilities = cache.get(grid, actions, sensor_readings, step, metrics=metrics)
+            renderer.render(canvas, probabilities, step, zoom)
+            pygame.image.save(canvas, base + f'_heatmap_step_{step}.png')
+
+        pygame.quit()
+        return
+
+    step_keys = {
+        pygame.K_RIGHT: lambda s: s + 1,
+        pygame.K_LEFT: lambda s: s - 1,
+        pygame.K_PAGEUP: lambda s: s + 10,
+        pygame.K_PAGEDOWN: lambda s: s - 10,
+        pygame.K_HOME: lambda s: 0,
+        pygame.K_END: lambda s: len(actions),
+    }
+    window = pygame.display.set_mode((width, height), pygame.RESIZABLE)
+    canvas_rect = pygame.Rect((0, 0), renderer.canvas_size(zoom))
+    dirty = True
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                sys.exit()
+
+            # Set moving true while mouse button is held
+            elif event.type == MOUSEBUTTONDOWN:
+                if canvas_rect.collidepoint(event.pos):
+                    moving = True
+
+            # Set moving false when mouse button is released
+            elif event.type == MOUSEBUTTONUP:
+                moving = False
+
+            # Click and drag image
+            elif event.type == MOUSEMOTION and moving:
+                canvas_rect.move_ip(event.rel)
+                dirty = True
+
+            # Zoom
+            elif event.type == MOUSEWHEEL:
+                if event.y > 0.1:
+                    zoom += 0.1
+                elif zoom > 0.2:
+                    zoom -= 0.1
+
+                canvas_rect.size = renderer.canvas_size(zoom)
+                dirty = True
+
+            # Change Step: right/left move one step, page up/down move ten, home/end jump to the first/last
+            elif event.type == KEYDOWN and event.key in step_keys:
+                next_step = min(max(step_keys[event.key](step), 0), len(actions))
+                if next_step != step:
+                    step = next_step
+                    probabilities = cache.get(grid, actions, sensor_readings, step, metrics=metrics)
+                    dirty = True
+
+            elif event.type in (VIDEORESIZE, VIDEOEXPOSE):
+                dirty = True
+
+        if dirty:
+            start = time.perf_counter()
+
+            # only the cells inside the window are drawn, straight onto the window surface
+            window.fill(Grid.WHITE)
+            renderer.render(window, probabilities, step, zoom, (-canvas_rect.left, -canvas_rect.top))
+
+            # Construct image border
+            pygame.draw.rect(window, Grid.WHITE, canvas_rect, 2)
+
+            # Update screen
+            pygame.display.update()
+            dirty = False
+
+            if metrics is not None:
+                metrics.time('render', time.perf_counter() - start)
+
+        pygame.time.wait(1)
+
+
+class GridRenderer:
+    """Draws a grid and its cell probabilities with pygame.
+
+    Fonts and rendered labels are cached, and only the cells that fall inside the target surface are drawn, so the
+    cost of a redraw depends on the size of the surface rather than the size of the grid.
+    """
+    BASE_CELL_SIZE = 150
+    BASE_BORDER_SIZE = 2
+    BASE_FONT_SIZE = 15
+    BASE_CIRCLE_RADIUS = 10
+    TERRAIN_COLORS = {
+        Grid.NORMAL: Grid.WHITE,
+        Grid.HIGHWAY: Grid.GOLD,
+        Grid.HARD_TO_TRAVERSE: Grid.GREEN,
+        Grid.BLOCKED: Grid.GRAY,
+    }
+    MAX_CACHED_LABELS = 4096
+
+    def __init__(self, grid):
+        self.grid = TerrainGrid.from_rows(grid)
+        self.colors = [GridRenderer.TERRAIN_COLORS[terrain] for terrain in TerrainGrid.TERRAINS]
+        self.fonts = {}
+        self.labels = {}
+
+    def font(self, size):
+        if size not in self.fonts:
+            self.fonts[size] = pygame.font.SysFont('calibri', size)
+        return self.fonts[size]
+
+    def label(self, text, size):
+        key = (text, size)
+        if key not in self.labels:
+            if len(self.labels) >= GridRenderer.MAX_CACHED_LABELS:
+                self.labels.clear()
+            self.labels[key] = self.font(size).render(text, True, Grid.BLACK)
+        return self.labels[key]
+
+    @classmethod
+    def sizes(cls, zoom):
+        border_size = max(1, round(GridRenderer.BASE_BORDER_SIZE * zoom))
+        cell_size = max(1, round(GridRenderer.BASE_CELL_SIZE * zoom))
+        font_size = max(1, round(GridRenderer.BASE_FONT_SIZE * zoom))
+        circle_radius = max(1, round(GridRenderer.BASE_CIRCLE_RADIUS * zoom))
+        return border_size, cell_size, font_size, circle_radius
+
+    def heatmap(self, probabilities, cell_size=1):
+        """RGB pixels (rows x columns x 3, cell_size pixels per cell) tinting each terrain color towards red by
+        the cell probability relative to the most likely cell."""
+        colors = numpy.array(self.colors, dtype=float)[self.grid.codes]
+        probabilities = numpy.asarray(probabilities)
+        weight = (probabilities / max(probabilities.max(), numpy.finfo(float).tiny))[..., None]
+        pixels = colors * (1 - weight) + numpy.array(Grid.RED, dtype=float) * weight
+        pixels[self.grid.blocked] = Grid.GRAY
+        pixels = pixels.round().astype(numpy.uint8)
+        return numpy.repeat(numpy.repeat(pixels, cell_size, axis=0), cell_size, axis=1)
+
+    def canvas_size(self, zoom):
+        cell_size = GridRenderer.sizes(zoom)[1]
+        return cell_size * (self.grid.columns + 1), cell_size * (self.grid.rows + 1)
+
+    def render(self, surface, probabilities, step, zoom, origin=(0, 0)):
+        """Draw the canvas at the given zoom, with the canvas point origin at the top left of surface."""
+        rows, columns = self.grid.rows, self.grid.columns
+        border_size, cell_size, font_size, circle_radius = GridRenderer.sizes(zoom)
+        offset = border_size // 2
+        pitch = cell_size - border_size
+        canvas_width, canvas_height = self.canvas_size(zoom)
+        surface_width, surface_height = surface.get_size()
+        x, y = origin
+
+        surface.fill(Grid.WHITE, pygame.Rect(-x, -y, canvas_width, canvas_height))
+
+        # Create border with the same size as the grid, centered in image.
+        border_rect = pygame.Rect(0, 0, columns * cell_size - (border_size * (columns - 1)),
+                                  rows * cell_size - (border_size * (rows - 1)))
+        border_rect.center = (canvas_width // 2, canvas_height // 2)
+        border_rect.move_ip(-x, -y)
+
+        # Only visit the cells that overlap the surface
+        first_row = max(0, -border_rect.top // max(1, pitch) - 1)
+        last_row = min(rows, (surface_height - border_rect.top) // max(1, pitch) + 1)
+        first_column = max(0, -border_rect.left // max(1, pitch) - 1)
+        last_column = min(columns, (surface_width - border_rect.left) // max(1, pitch) + 1)
+
+        for row in range(first_row, last_row):
+            top = border_rect.top + row * pitch
+            codes = self.grid.codes[row]
+            for column in range(first_column, last_column):
+                left = border_rect.left + column * pitch
+                cell_rect = pygame.Rect(left, top, cell_size, cell_size)
+
+                # draw cell color and borders
+                surface.fill(self.colors[codes[column]], cell_rect)
+                pygame.draw.rect(surface, Grid.BLACK, cell_rect, border_size)
+
+                # draw cell probabilities
+                probability_label = self.label("{:.7f}".format(probabilities[row][column] * 100) + "%", font_size)
+                surface.blit(probability_label,
+                             probability_label.get_rect(center=(left + cell_size // 2, top + cell_size // 2)))
+
+        # draw grid labels
+        for column in range(max(1, first_column), min(columns + 1, last_column + 1) + 1):
+            x_label = self.label(str(column), font_size)
+            surface.blit(x_label, x_label.get_rect(center=(border_rect.left - column + (column - 1) * (cell_size - offset),
+                                                           border_rect.top - 4 * circle_radius)))
+        for row in range(max(1, first_row), min(rows + 1, last_row + 1) + 1):
+            y_label = self.label(str(row), font_size)
+            surface.blit(y_label, y_label.get_rect(center=(border_rect.left - 4 * circle_radius,
+                                                           border_rect.top - row + (row - 1) * (cell_size - offset))))
+
+        # draw step label
+        step_label = self.label(f'Step: {step}', font_size)
+        surface.blit(step_label, step_label.get_rect(left=font_size / 2 - x, top=font_size / 2 - y))
+
+
+def init_heatmap_worker():
+    # render without a display, initializing pygame once per worker process; SDL must not take over SIGTERM or the
+    # pool can not terminate its workers
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_NO_SIGNAL_HANDLERS'] = '1'
+    pygame.init()
+
+
+def export_heatmaps(grid_filepath, experiment_filepath, steps=(10, 50, 100), labels=False, cell_size=10):
+    base = os.path.splitext(experiment_filepath)[0]
+    outputs = [base + f'_heatmap_step_{step}.png' for step in steps]
+    if all(os.path.exists(output) for output in outputs):
+        return []
+
+    grid = Grid.import_grid(grid_filepath)
+    ground_truth_states, actions, sensor_readings = Grid.import_experiment(experiment_filepath, max(steps))
+    renderer = GridRenderer(grid)
+    canvas = pygame.Surface(renderer.canvas_size(1)) if labels else None
+
+    written = []
+    probabilities, current = None, 0
+    for step, output in zip(steps, outputs):
+        probabilities = Grid.calculate_next_probabilities(grid, actions, sensor_readings, current, step, probabilities)
+        current = step
+        if os.path.exists(output):
+            continue
+
+        if labels:
+            renderer.render(canvas, probabilities, step, 1)
+            image = canvas
+        else:
+            image = pygame.surfarray.make_surface(renderer.heatmap(probabilities, cell_size).transpose(1, 0, 2))
+
+        # write to a temporary file first so an interrupted export never leaves a partial image behind
+        partial = os.path.splitext(output)[0] + '.partial.png'
+        pygame.image.save(image, partial)
+        os.replace(partial, output)
+        written.append(output)
+    return written